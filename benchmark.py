@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark for the KLV/MISB 0601 decoder.
+# Generates a synthetic stream of UAS Local Set packets and reports how many
+# packets per second each decoding path gets through.
+#
+# With --ts it instead compares demuxing KLV out of local MPEG-TS files
+# natively against going through ffprobe/ffmpeg.
+#
+# Usage:
+# >$ python3 benchmark.py [number of packets]
+# >$ python3 benchmark.py --ts file.ts [file.ts ...]
+
+import open_telemetry_kit as otk
+from open_telemetry_kit.klv_encoder import KLVEncoder
+from open_telemetry_kit.klv_common import read_len, read_ber_oid, misb_checksum
+from open_telemetry_kit.telemetry import Telemetry
+from open_telemetry_kit.packet import Packet
+from open_telemetry_kit.detector import read_video_metadata, read_klv
+
+from io import BytesIO
+import os
+import shutil
+import sys
+import time
+from typing import List
+
+UAS_KEY = bytes.fromhex("06 0E 2B 34 02 0B 01 01 0E 01 03 01 01 00 00 00")
+
+def ber_len(length: int) -> bytes:
+  if length < 128:
+    return bytes([length])
+  size = (length.bit_length() + 7) // 8
+  return bytes([128 + size]) + length.to_bytes(size, "big")
+
+def tlv(tag: int, value: bytes) -> bytes:
+  return bytes([tag]) + ber_len(len(value)) + value
+
+def synthetic_packet(idx: int) -> bytes:
+  body = tlv(2, (1577836800000000 + idx * 33333).to_bytes(8, "big"))
+  body += tlv(3, b"OTK BENCHMARK")
+  body += tlv(5, (idx % 2**16).to_bytes(2, "big"))
+  body += tlv(6, (idx % 2**15).to_bytes(2, "big", signed=True))
+  body += tlv(13, (idx * 1000).to_bytes(4, "big", signed=True))
+  body += tlv(14, (-idx * 1000).to_bytes(4, "big", signed=True))
+  body += tlv(15, (idx % 2**16).to_bytes(2, "big"))
+  body += tlv(23, (idx * 999).to_bytes(4, "big", signed=True))
+  body += tlv(24, (-idx * 999).to_bytes(4, "big", signed=True))
+  body += tlv(65, bytes([11]))
+  # Checksum covers everything up to and including its own tag and length
+  packet = UAS_KEY + ber_len(len(body) + 4) + body + bytes([1, 2])
+  return packet + misb_checksum(memoryview(packet), 0, len(packet)).to_bytes(2, "big")
+
+def synthetic_stream(num_packets: int) -> bytes:
+  return b"".join(synthetic_packet(idx) for idx in range(num_packets))
+
+# The original BytesIO decoder, reproduced here as the baseline to compare against
+def bytesio_parse(parser: otk.KLVParser, klv: bytes) -> Telemetry:
+  stream = BytesIO(klv)
+  stream_end = len(klv)
+  tel = Telemetry()
+  while stream.tell() < stream_end:
+    key = stream.read(16)
+    if key not in parser.keys:
+      stream.seek(-15, os.SEEK_CUR)
+      continue
+
+    packet_end = read_len(stream) + stream.tell()
+    packet = Packet()
+    while stream.tell() != packet_end:
+      tag = read_ber_oid(stream)
+      value = stream.read(read_len(stream))
+      element_cls = parser.element_dict[tag]
+      packet[element_cls.misb_name] = element_cls.fromMISB(value)
+    tel.append(packet)
+
+  return tel
+
+def run(name: str, func, data, num_packets: int):
+  beg = time.perf_counter()
+  func(data)
+  elapsed = time.perf_counter() - beg
+  print("{:<12} {:>8.3f} s {:>12.0f} packets/s".format(name, elapsed, num_packets / elapsed))
+
+def ffmpeg_read(path: str) -> Telemetry:
+  parser = otk.KLVParser(path)
+  return parser._parse(read_klv(path, read_video_metadata(path)))
+
+def native_read(path: str) -> Telemetry:
+  return otk.KLVParser(path).read()
+
+def run_ts(paths: List[str]):
+  have_ffmpeg = shutil.which("ffmpeg") and shutil.which("ffprobe")
+  if not have_ffmpeg:
+    print("ffmpeg/ffprobe not found. Only timing the native demuxer")
+
+  for path in paths:
+    num_packets = len(native_read(path))
+    print("{}: {} packets, {} bytes".format(path, num_packets, os.path.getsize(path)))
+    run("native", native_read, path, num_packets)
+    if have_ffmpeg:
+      run("ffmpeg", ffmpeg_read, path, num_packets)
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1 and sys.argv[1] == "--ts":
+    run_ts(sys.argv[2:])
+    sys.exit(0)
+
+  num_packets = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  klv = synthetic_stream(num_packets)
+  print("{} packets, {} bytes".format(num_packets, len(klv)))
+
+  parser = otk.KLVParser("benchmark")
+  run("BytesIO", lambda data: bytesio_parse(parser, data), klv, num_packets)
+  run("memoryview", parser._parse, klv, num_packets)
+
+  parser = otk.KLVParser("benchmark", verify_checksum=True)
+  run("checksum", parser._parse, klv, num_packets)
+
+  # Encoding runs the other way so time it over the decoded telemetry
+  tel = parser._parse(klv)
+  encoder = KLVEncoder()
+  run("encode", encoder.encode, tel, num_packets)
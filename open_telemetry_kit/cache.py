@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Opt-in on-disk cache of telemetry extracted from videos, so re-reading an
+# unchanged file skips ffprobe/ffmpeg. Entries are keyed by the source's path,
+# size and mtime plus any options that change what's stored, and are evicted
+# by age and by the total size of the cache
+#
+# >>> import open_telemetry_kit.cache as cache
+# >>> cache.enable_cache()
+#
+# or set OTK_CACHE_DIR in the environment
+
+import hashlib
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from typing import Any, Callable
+
+logger = logging.getLogger("OTK.cache")
+
+DEFAULT_MAX_BYTES = 2**30
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+
+class TelemetryCache:
+  # directory: Where entries are kept. Created if needed
+  # max_bytes: Total size of the entries before the least recently used are evicted
+  # max_age: Seconds since an entry was last used before it's evicted
+  def __init__(self, directory: str,
+               max_bytes: int = DEFAULT_MAX_BYTES,
+               max_age: float = DEFAULT_MAX_AGE):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    os.makedirs(directory, exist_ok=True)
+
+  # Returns the key for src with the given options, or None if src can't be
+  # stat'd (e.g. it's a stream rather than a file)
+  def key(self, src: str, *options: Any) -> str:
+    try:
+      stat = os.stat(src)
+    except OSError:
+      return None
+    ident = (os.path.abspath(src), stat.st_size, stat.st_mtime_ns) + options
+    return hashlib.sha1(repr(ident).encode("utf-8")).hexdigest()
+
+  # Returns the path of the entry if it exists, marking it as recently used
+  def path(self, key: str, kind: str) -> str:
+    path = os.path.join(self.directory, key + "." + kind)
+    try:
+      os.utime(path)
+    except OSError:
+      return None
+    logger.info("Cache hit for {}".format(path))
+    return path
+
+  def load(self, key: str, kind: str) -> bytes:
+    path = self.path(key, kind)
+    if path is None:
+      return None
+    try:
+      with open(path, "rb") as fl:
+        return fl.read()
+    except OSError:
+      return None
+
+  # Writes the entry atomically so concurrent readers never see part of one
+  def store(self, key: str, kind: str, data: bytes) -> str:
+    def write(tmp: str):
+      with open(tmp, "wb") as fl:
+        fl.write(data)
+    return self.store_file(key, kind, write)
+
+  # Same as store but write(path) writes the entry to path itself (e.g. by
+  # having ffmpeg output to it) so it never has to be held in memory
+  def store_file(self, key: str, kind: str, write: Callable[[str], None]) -> str:
+    path = os.path.join(self.directory, key + "." + kind)
+    tmp = None
+    try:
+      fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+      os.close(fd)
+      write(tmp)
+      os.replace(tmp, path)
+    except (OSError, subprocess.CalledProcessError) as e:
+      logger.warn("Could not write cache entry {}: {}".format(path, e))
+      if tmp is not None:
+        self._remove(tmp)
+      return None
+
+    self.evict(keep=path)
+    return path
+
+  # Starts an entry that's written a piece at a time (e.g. while it's being
+  # parsed). Returns None if it can't be created
+  def open_entry(self, key: str, kind: str) -> 'CacheEntryWriter':
+    try:
+      return CacheEntryWriter(self, key, kind)
+    except OSError as e:
+      logger.warn("Could not create cache entry {}.{}: {}".format(key, kind, e))
+      return None
+
+  # Removes entries unused for longer than max_age, then the least recently
+  # used entries until the cache fits in max_bytes
+  # keep: Entry that's never evicted, e.g. one that was just written
+  def evict(self, keep: str = None):
+    now = time.time()
+    entries = []
+    for name in os.listdir(self.directory):
+      path = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      if name.endswith(".tmp"):
+        # Left behind by a writer that died. Give live writers an hour
+        if now - stat.st_mtime > 3600:
+          self._remove(path)
+      elif now - stat.st_mtime > self.max_age:
+        self._remove(path)
+      elif path != keep:
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    if keep is not None and os.path.exists(keep):
+      total += os.path.getsize(keep)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      self._remove(path)
+      total -= size
+
+  def clear(self):
+    for name in os.listdir(self.directory):
+      self._remove(os.path.join(self.directory, name))
+
+  def _remove(self, path: str):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+# Entry written a piece at a time to a temporary file. commit() moves it into
+# place so readers never see part of one, abort() throws it away
+class CacheEntryWriter:
+  def __init__(self, cache: TelemetryCache, key: str, kind: str):
+    self.cache = cache
+    self.path = os.path.join(cache.directory, key + "." + kind)
+    fd, self.tmp = tempfile.mkstemp(dir=cache.directory, suffix=".tmp")
+    self.file = os.fdopen(fd, "wb")
+    self.failed = False
+
+  # Write errors (e.g. a full disk) only abandon the entry, not the caller's work
+  def write(self, data: bytes):
+    if self.failed:
+      return
+    try:
+      self.file.write(data)
+    except OSError as e:
+      logger.warn("Could not write cache entry {}: {}".format(self.path, e))
+      self.failed = True
+
+  def commit(self) -> str:
+    if self.failed:
+      self.abort()
+      return None
+    try:
+      self.file.close()
+      os.replace(self.tmp, self.path)
+    except OSError as e:
+      logger.warn("Could not write cache entry {}: {}".format(self.path, e))
+      self.abort()
+      return None
+
+    self.cache.evict(keep=self.path)
+    return self.path
+
+  def abort(self):
+    self.file.close()
+    self.cache._remove(self.tmp)
+
+_cache = None
+
+def default_directory() -> str:
+  base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+  return os.path.join(base, "open_telemetry_kit")
+
+def enable_cache(directory: str = None,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age: float = DEFAULT_MAX_AGE) -> TelemetryCache:
+  global _cache
+  _cache = TelemetryCache(directory or default_directory(), max_bytes, max_age)
+  return _cache
+
+def disable_cache():
+  global _cache
+  _cache = None
+
+# The enabled cache, if any. Setting OTK_CACHE_DIR enables it
+def get_cache() -> TelemetryCache:
+  if _cache is None and os.environ.get("OTK_CACHE_DIR"):
+    enable_cache(os.environ["OTK_CACHE_DIR"])
+  return _cache
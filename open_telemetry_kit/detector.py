@@ -1,12 +1,26 @@
 from .parser import Parser
+from .telemetry import Telemetry
+from .cache import get_cache
+from .element import Element
+from .isobmff import read_metadata as read_isobmff_metadata, is_isobmff
+from .mpegts import TSDemuxer, TS_PACKET_SIZE, SYNC_BYTE
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import copy
+from fractions import Fraction
 import os
 import json
 import logging
+import re
 import subprocess
-from typing import Dict, Tuple, Union, List
+import threading
+from typing import Any, BinaryIO, Callable, Dict, Iterator, Tuple, Union, List
 JSONType = Dict[str, Union[List[Dict[str, Union[str, int]]], Dict[str,Union[str, int]]]]
 logger = logging.getLogger("OTK.detector")
 
+# Extensions of raw KLV dumps, parsed as standalone 'klv' telemetry
+RAW_KLV_EXTENSIONS = (".klv", ".bin")
+
 def split_path(src: str) -> Tuple[str, str, str]:
   path, filename = os.path.split(src)
 
@@ -16,9 +30,116 @@ def split_path(src: str) -> Tuple[str, str, str]:
 
   return (path, "", "")
 
-def read_video_metadata(src: str) -> JSONType:
-  data_raw = os.popen("ffprobe -v quiet -print_format json -show_format -show_streams " + src).read()
-  return json.loads(data_raw)
+# ffprobe output for recently probed files, least recently used first
+# Keyed by path, mtime and size so a file that changes is probed again
+METADATA_CACHE_SIZE = 128
+_metadata_cache = OrderedDict()
+_metadata_lock = threading.Lock()
+
+# Defaults for probing batches of files
+PROBE_WORKERS = 8
+PROBE_TIMEOUT = 60
+
+def _metadata_key(src: str) -> Tuple[str, int, int]:
+  try:
+    stat = os.stat(src)
+  except OSError:
+    # Not a local file (e.g. a URL) so there's nothing to tell if it changed
+    return None
+  return (os.path.abspath(src), stat.st_mtime_ns, stat.st_size)
+
+# Each file is only probed once for as long as it's unchanged and in the
+# cache. Callers get their own copy of the metadata
+# MP4/MOV files are read directly. ffprobe is only run for other containers
+# timeout: Seconds ffprobe may run before it's killed
+# Returns None if src can't be probed
+def read_video_metadata(src: str, timeout: float = None) -> JSONType:
+  key = _metadata_key(src)
+  if key is not None:
+    with _metadata_lock:
+      if key in _metadata_cache:
+        _metadata_cache.move_to_end(key)
+        return copy.deepcopy(_metadata_cache[key])
+
+  metadata = read_isobmff_metadata(src) if key is not None else None
+  if metadata is None:
+    metadata = _probe(src, timeout)
+    if metadata is None:
+      return None
+
+  if key is not None:
+    with _metadata_lock:
+      _metadata_cache[key] = metadata
+      if len(_metadata_cache) > METADATA_CACHE_SIZE:
+        _metadata_cache.popitem(last=False)
+    metadata = copy.deepcopy(metadata)
+
+  return metadata
+
+# Same as read_video_metadata for many files at once. Files are probed
+# concurrently by up to max_workers threads (each running its own ffprobe)
+# and the results are in the same order as srcs
+def read_video_metadata_batch(srcs: List[str],
+                              max_workers: int = PROBE_WORKERS,
+                              timeout: float = PROBE_TIMEOUT) -> List[JSONType]:
+  # Each file is only probed once even if it's listed more than once
+  unique = list(OrderedDict.fromkeys(srcs))
+  if not unique:
+    return []
+
+  # A file that can't be probed gets None rather than failing the batch
+  def probe(src: str) -> JSONType:
+    try:
+      return read_video_metadata(src, timeout)
+    except Exception as e:
+      logger.warn("Could not read the metadata of {}: {}".format(src, e))
+      return None
+
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(unique))) as pool:
+    probed = dict(zip(unique, pool.map(probe, unique)))
+
+  metadatas = []
+  seen = set()
+  for src in srcs:
+    # Repeats get their own copy, the same as from read_video_metadata
+    metadatas.append(copy.deepcopy(probed[src]) if src in seen else probed[src])
+    seen.add(src)
+  return metadatas
+
+# Runs ffprobe on src. If the on-disk cache is enabled the output is kept
+# there so other processes don't have to probe an unchanged file again
+def _probe(src: str, timeout: float = None) -> JSONType:
+  cache = get_cache()
+  key = cache.key(src) if cache is not None else None
+  if key is not None:
+    data_raw = cache.load(key, "probe")
+    if data_raw is not None:
+      return json.loads(data_raw)
+
+  cmd = ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", src]
+  try:
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, timeout=timeout)
+  except subprocess.TimeoutExpired:
+    logger.warn("ffprobe timed out after {} seconds on {}".format(timeout, src))
+    return None
+  if proc.returncode != 0:
+    logger.warn("ffprobe could not read {} (exit code {})".format(src, proc.returncode))
+    return None
+
+  data_raw = proc.stdout
+  try:
+    metadata = json.loads(data_raw)
+  except ValueError:
+    logger.warn("ffprobe gave invalid output for {}".format(src))
+    return None
+
+  if key is not None:
+    cache.store(key, "probe", data_raw)
+  return metadata
+
+def clear_metadata_cache():
+  with _metadata_lock:
+    _metadata_cache.clear()
 
 def read_video_metadata_file(src: str):
   with open(src, 'r') as fl:
@@ -36,46 +157,189 @@ def get_embedded_telemetry_type(metadata: JSONType) -> str:
   logger.error("Unsupported embedded telemetry type.")
   return None
 
+# tel_type -> Parser subclass and the column names CSV headers are
+# recognized by. Built the first time they're needed
+_parser_table = None
+_csv_columns = None
+
+def _parsers() -> Dict[str, type]:
+  global _parser_table
+  if _parser_table is None:
+    _parser_table = {cls.tel_type : cls for cls in Parser.__subclasses__()}
+  return _parser_table
+
+def _known_columns() -> set:
+  global _csv_columns
+  if _csv_columns is None:
+    _csv_columns = {name for cls in Element.__subclasses__() for name in cls.names}
+  return _csv_columns
+
+# Bytes read from the start of a file to recognize its format
+SNIFF_SIZE = 4096
+
+# Index line followed by a timeframe line, e.g.
+# 1
+# 00:00:00,033 --> 00:00:00,066
+_SRT_START = re.compile(r"\d+[ \t]*\r?\n[ \t]*\d+:\d+:\d+[,.]\d+[ \t]*-->")
+_XML_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+# First element, skipping the declaration, processing instructions and doctype
+_XML_ROOT = re.compile(r"<([A-Za-z_][^\s>/]*)")
+
+def _read_head(src: str) -> bytes:
+  try:
+    with open(src, "rb") as fl:
+      return fl.read(SNIFF_SIZE)
+  except OSError:
+    return b""
+
+# Recognizes the format of a file from its first few KB. Returns one of
+# 'srt', 'csv', 'gpx', 'kml', 'klv' (raw KLV), 'mpegts', 'isobmff' or None
+def sniff_format(head: bytes) -> str:
+  # Only sets the KLV parser knows count. Other formats start with SMPTE
+  # universal labels too (e.g. MXF partition packs)
+  klv = _parsers().get("klv")
+  if klv is not None and head[:16] in klv.keys:
+    return "klv"
+  if len(head) > TS_PACKET_SIZE and head[0] == SYNC_BYTE and head[TS_PACKET_SIZE] == SYNC_BYTE:
+    return "mpegts"
+  if is_isobmff(head):
+    return "isobmff"
+  if b"\x00" in head:
+    return None
+
+  text = head.decode("utf-8", errors="replace").lstrip("\ufeff \t\r\n")
+  if text.startswith("<"):
+    root = _XML_ROOT.search(_XML_COMMENT.sub("", text))
+    if root:
+      # Drop any namespace prefix
+      tag = root[1].split(":")[-1].lower()
+      if tag in ("gpx", "kml"):
+        return tag
+    return None
+
+  if _SRT_START.match(text):
+    return "srt"
+
+  header = text.split("\n", 1)[0].strip()
+  columns = [column.strip().strip('"') for column in header.split(",")]
+  if len(columns) > 1 and any(column in _known_columns() for column in columns):
+    return "csv"
+  return None
+
+# (type, embedded) of src as far as can be told without running ffprobe, or
+# None if it has to be probed
+def _detect_without_probe(src: str) -> Tuple[str, bool]:
+  parsers = _parsers()
+  head = _read_head(src)
+  fmt = sniff_format(head)
+
+  if fmt == "mpegts":
+    # The PMT is usually in the first few packets. If it's further in
+    # than that leave it to ffprobe
+    demuxer = TSDemuxer()
+    demuxer.feed(head)
+    if demuxer.klv_pids and "klv" in parsers:
+      return ("klv", True)
+    return None
+
+  if fmt == "isobmff":
+    metadata = read_isobmff_metadata(src)
+    if metadata is None:
+      return None
+    tel_type = get_embedded_telemetry_type(metadata)
+    return (tel_type, True) if tel_type in parsers else (None, False)
+
+  if fmt in parsers:
+    return (fmt, False)
+
+  # Fall back on the extension
+  _, _, ext = split_path(src)
+  if ext in RAW_KLV_EXTENSIONS and "klv" in parsers:
+    return ("klv", False)
+  if ext.strip('.') in parsers:
+    return (ext.strip('.'), False)
+  return None
+
 # If supported return the extension and bool
 #   False: Telemetry is not embedded in video file (in it's own file)
 #   True: Telemetry is embedded in video file
-# TODO: Rewrite so we're not doing the same search twice.
-# Not a huge deal now, but as more types get supported will get worse
-def get_telemetry_type(src: str) -> Tuple[str, bool]:
-  _, _, ext = split_path(src)
-  supported = [cls.tel_type for cls in Parser.__subclasses__()]
-  if ext.strip('.') in supported:
-    logger.info("Found independent telemetry of type '{}'".format(ext.strip('.')))
-    return (ext.strip('.'), False)
+# The format is recognized from the content of the file where possible, then
+# from its extension. Only other videos are probed with ffprobe
+# metadata: The video's metadata if it's already been read
+def get_telemetry_type(src: str, metadata: JSONType = None) -> Tuple[str, bool]:
+  if metadata is None:
+    detected = _detect_without_probe(src)
+    if detected is not None:
+      if detected[0] is None:
+        logger.error("{} contains an unsupported telemetry type".format(src))
+      elif detected[1]:
+        logger.info("Found embedded telemetry of type '{}'".format(detected[0]))
+      else:
+        logger.info("Found independent telemetry of type '{}'".format(detected[0]))
+      return detected
+
+    metadata = read_video_metadata(src)
 
-  metadata = read_video_metadata(src)
   if metadata:
     tel_type = get_embedded_telemetry_type(metadata)
 
-    if tel_type and tel_type in supported:
+    if tel_type and tel_type in _parsers():
       logger.info("Found embedded telemetry of type '{}'".format(tel_type))
       return (tel_type, True)
   
   logger.error("{} contains an unsupported telemetry type".format(src))
   return (None, False)
+
+# Same as get_telemetry_type for many files at once. Videos are probed
+# concurrently (see read_video_metadata_batch) and the results are in the
+# same order as srcs
+def get_telemetry_types(srcs: List[str],
+                        max_workers: int = PROBE_WORKERS,
+                        timeout: float = PROBE_TIMEOUT) -> List[Tuple[str, bool]]:
+  detected = [_detect_without_probe(src) for src in srcs]
+  videos = [src for src, tel_type in zip(srcs, detected) if tel_type is None]
+  metadatas = dict(zip(videos, read_video_metadata_batch(videos, max_workers, timeout)))
+
+  tel_types = []
+  for src, tel_type in zip(srcs, detected):
+    if tel_type is not None:
+      tel_types.append(tel_type)
+    elif metadatas[src] is None:
+      # Probing failed or timed out
+      logger.error("Could not read the metadata of {}".format(src))
+      tel_types.append((None, False))
+    else:
+      tel_types.append(get_telemetry_type(src, metadatas[src]))
+  return tel_types
+
+# Telemetry type of every file in a directory (not its subdirectories) as
+# path -> (type, embedded), sorted by path
+def get_directory_telemetry_types(directory: str,
+                                  max_workers: int = PROBE_WORKERS,
+                                  timeout: float = PROBE_TIMEOUT) -> Dict[str, Tuple[str, bool]]:
+  srcs = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                if os.path.isfile(os.path.join(directory, name)))
+  return OrderedDict(zip(srcs, get_telemetry_types(srcs, max_workers, timeout)))
     
 def create_telemetry_parser(src: str) -> Parser:
   tel_type, embedded = get_telemetry_type(src)
 
-  for cls in Parser.__subclasses__():
-    if tel_type == cls.tel_type:
-      logger.info("Creating parser objecet: {}".format(cls.__name__))
-      if not embedded:
-        return cls(src)
-      else:
-        return cls(src, is_embedded=embedded)
+  cls = _parsers().get(tel_type)
+  if cls is not None:
+    logger.info("Creating parser objecet: {}".format(cls.__name__))
+    if not embedded and tel_type == "klv":
+      return cls(src, is_embedded=False)
+    elif not embedded:
+      return cls(src)
+    else:
+      return cls(src, is_embedded=embedded)
 
 def read_embedded_subtitles(src: str) -> str:
   cmd = "ffmpeg -y -i " + src + " -f srt - " 
   srt = os.popen(cmd).read()
   return srt
 
-def read_klv(src: str, metadata: JSONType) -> bytes:
+def _klv_cmd(src: str, metadata: JSONType, dest: str = "-") -> List[str]:
   klv_idx = None
   if "streams" in metadata:
       for idx, stream in enumerate(metadata["streams"]):
@@ -83,6 +347,176 @@ def read_klv(src: str, metadata: JSONType) -> bytes:
           klv_idx = str(idx)
           break
 
-  cmd = ["ffmpeg", "-loglevel", "quiet", "-i" , src , "-map", "0:" + klv_idx, "-codec", "copy", "-f", "data", "-"]
+  return ["ffmpeg", "-y", "-loglevel", "quiet", "-i" , src , "-map", "0:" + klv_idx, "-codec", "copy", "-f", "data", dest]
+
+def read_klv(src: str, metadata: JSONType) -> bytes:
+  cmd = _klv_cmd(src, metadata)
   klv = subprocess.run(cmd, stdout=subprocess.PIPE).stdout
-  return klv
\ No newline at end of file
+  return klv
+
+# Same as read_klv but hands back the running ffmpeg process so the caller
+# can consume its stdout incrementally instead of waiting for it to exit
+def open_klv_stream(src: str, metadata: JSONType) -> subprocess.Popen:
+  cmd = _klv_cmd(src, metadata)
+  return subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+
+# Same as read_klv but has ffmpeg write the KLV stream straight to a file
+def extract_klv(src: str, metadata: JSONType, dest: str):
+  cmd = _klv_cmd(src, metadata, dest)
+  subprocess.run(cmd, check=True)
+
+# Index of the first stream of each kind of telemetry in a video
+#   'srt': Subtitle track (extracted as SRT)
+#   'klv': KLVA data track
+def _telemetry_streams(metadata: JSONType) -> Dict[str, int]:
+  streams = {}
+  if "streams" in metadata:
+    for idx, stream in enumerate(metadata["streams"]):
+      if stream["codec_type"] == "subtitle" and "srt" not in streams:
+        streams["srt"] = idx
+      elif stream["codec_type"] == "data" and stream["codec_tag_string"] == "KLVA" and "klv" not in streams:
+        streams["klv"] = idx
+  return streams
+
+# Starts a single ffmpeg process that writes every telemetry stream in src to
+# a pipe of its own, along with the container's tags and chapters (as
+# ffmetadata), so the video is only read once
+# Returns the process and kind -> pipe, kinds being those of
+# _telemetry_streams plus 'ffmetadata'. Every pipe has to be read to the
+# end or ffmpeg blocks writing to it
+def open_telemetry_streams(src: str, metadata: JSONType = None) -> Tuple[subprocess.Popen, Dict[str, BinaryIO]]:
+  if metadata is None:
+    metadata = read_video_metadata(src)
+
+  cmd = ["ffmpeg", "-y", "-loglevel", "quiet", "-i", src]
+  outputs = []
+  for kind, idx in _telemetry_streams(metadata).items():
+    if kind == "srt":
+      outputs.append((kind, ["-map", "0:" + str(idx), "-f", "srt"]))
+    else:
+      outputs.append((kind, ["-map", "0:" + str(idx), "-codec", "copy", "-f", "data"]))
+  outputs.append(("ffmetadata", ["-f", "ffmetadata"]))
+
+  # ffmpeg writes each output to the write end of a pipe it inherits
+  pipes = {}
+  write_fds = []
+  try:
+    for kind, args in outputs:
+      read_fd, write_fd = os.pipe()
+      pipes[kind] = os.fdopen(read_fd, "rb")
+      write_fds.append(write_fd)
+      cmd.extend(args + ["pipe:" + str(write_fd)])
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, pass_fds=write_fds)
+  except BaseException:
+    for pipe in pipes.values():
+      pipe.close()
+    raise
+  finally:
+    for fd in write_fds:
+      os.close(fd)
+
+  return proc, pipes
+
+# Same as open_telemetry_streams but each stream is handed to its consumer
+# in a thread of its own as ffmpeg writes it
+# consumers: kind -> function taking the stream's pipe. Streams without one
+#   are read into bytes, except ffmetadata which is parsed (parse_ffmetadata)
+# Returns kind -> what its consumer returned
+def read_telemetry_streams(src: str,
+                           metadata: JSONType = None,
+                           consumers: Dict[str, Callable[[BinaryIO], Any]] = {}) -> Dict[str, Any]:
+  proc, pipes = open_telemetry_streams(src, metadata)
+
+  def consume(kind: str) -> Any:
+    pipe = pipes[kind]
+    try:
+      if kind in consumers:
+        return consumers[kind](pipe)
+      elif kind == "ffmetadata":
+        return parse_ffmetadata(pipe.read().decode("utf-8", errors="replace"))
+      else:
+        return pipe.read()
+    finally:
+      # Anything the consumer left would block ffmpeg
+      while pipe.read(2**16):
+        pass
+      pipe.close()
+
+  try:
+    with ThreadPoolExecutor(max_workers=len(pipes)) as pool:
+      futures = {kind : pool.submit(consume, kind) for kind in pipes}
+    return {kind : future.result() for kind, future in futures.items()}
+  finally:
+    proc.wait()
+
+# Parses every kind of telemetry embedded in src from a single ffmpeg run.
+# Each parser works on its stream while the others are being extracted
+# parser_args: tel_type -> keyword arguments for that type's parser, e.g.
+#   {"srt" : {"require_timestamp" : True}}
+# Returns (tel_type -> Telemetry, tags and chapters of the container)
+def read_all_telemetry(src: str, parser_args: Dict[str, Dict[str, Any]] = {}) -> Tuple[Dict[str, Telemetry], Dict]:
+  metadata = read_video_metadata(src)
+  consumers = {}
+  for kind in _telemetry_streams(metadata):
+    cls = _parsers().get(kind)
+    if cls is not None:
+      consumers[kind] = cls(src, is_embedded=True, **parser_args.get(kind, {}))._read_pipe
+
+  streams = read_telemetry_streams(src, metadata, consumers)
+  ffmetadata = streams.pop("ffmetadata")
+  return {kind : tel for kind, tel in streams.items() if kind in consumers}, ffmetadata
+
+# Splits ffmetadata into (key, value) per line, undoing backslash escapes
+# Lines without a '=' (section headers, comments) have a key of None
+def _ffmetadata_lines(text: str) -> Iterator[Tuple[str, str]]:
+  key = None
+  value = []
+  escaped = False
+  for char in text + "\n":
+    if escaped:
+      value.append(char)
+      escaped = False
+    elif char == "\\":
+      escaped = True
+    elif char == "\n":
+      yield key, "".join(value)
+      key = None
+      value = []
+    elif char == "=" and key is None:
+      key = "".join(value)
+      value = []
+    else:
+      value.append(char)
+
+# Parses the output of ffmpeg -f ffmetadata into
+# {"tags" : {...}, "chapters" : [{"start" : s, "end" : s, "tags" : {...}}, ...]}
+# with chapter times in seconds
+def parse_ffmetadata(text: str) -> Dict:
+  metadata = {"tags" : {}, "chapters" : []}
+  tags = metadata["tags"]
+  chapter = None
+  for key, value in _ffmetadata_lines(text):
+    if key is None:
+      if value.strip() == "[CHAPTER]":
+        # Times without a timebase are in nanoseconds
+        chapter = {"timebase" : "1/1000000000", "start" : 0, "end" : 0, "tags" : {}}
+        metadata["chapters"].append(chapter)
+        tags = chapter["tags"]
+      elif value.strip().startswith("["):
+        # Per stream tags aren't used
+        chapter = None
+        tags = {}
+    elif key.startswith((";", "#")):
+      continue
+    elif chapter is not None and key in ("TIMEBASE", "START", "END"):
+      chapter[key.lower()] = value.strip()
+    else:
+      tags[key] = value
+
+  for chapter in metadata["chapters"]:
+    timebase = Fraction(chapter.pop("timebase"))
+    chapter["start"] = float(int(chapter["start"]) * timebase)
+    chapter["end"] = float(int(chapter["end"]) * timebase)
+
+  return metadata
@@ -1,10 +1,11 @@
 from .element import Element
-from .misb_0601 import MISB_0601, MISB_int, MISB_float, MISB_str 
-from .klv_common import bytes_to_int, bytes_to_float, bytes_to_str, read_len, read_ber_oid
+from .misb_0601 import MISB_0601, MISB_int, MISB_float, MISB_str, MISB_LocalSet
+from .klv_common import bytes_to_int, bytes_to_float, bytes_to_str, read_len, read_ber_oid, LocalSetView
 from datetime import datetime
 from dateutil import parser as dup
 from io import BytesIO
-from typing import List
+import struct
+from typing import List, Tuple
 
 class ChecksumElement(Element, MISB_int):
   name = "checksum"
@@ -14,6 +15,7 @@ class ChecksumElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 02 03 01 00 00 00"
   misb_tag = 1
   misb_units = "None"
+  _width = 2
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -26,6 +28,7 @@ class TimestampElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 03 07 02 01 01 01 05 00 00"
   misb_tag = 2
   misb_units = "Microseconds"
+  _width = 8
 
   _state_code = {0 : "seconds",
                 1 : "milliseconds",
@@ -42,6 +45,15 @@ class TimestampElement(Element, MISB_int):
     ts = cls(0).to_microseconds()
     ts.value = bytes_to_int(value)
     return ts
+
+  @classmethod
+  def encoder(cls):
+    # Scale from the element's current state without converting it in place
+    to_micro = {cls._state_code[0] : 1e6,
+                cls._state_code[1] : 1e3,
+                cls._state_code[2] : 1}
+    pack = struct.Struct(">Q").pack
+    return lambda element: pack(int(round(element.value * to_micro[element.state])))
   
   def to_seconds(self):
     if self.state == self._state_code[1]:
@@ -95,6 +107,7 @@ class MissionIDElement(Element, MISB_str):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 04 01 03 00 00 00"
   misb_tag = 3
   misb_units = "None"
+  misb_shared = True
 
   def __init__(self, value: str):
     self.value = str(value)
@@ -192,6 +205,7 @@ class PlatformDesignationElement(Element, MISB_str):
   misb_key = "06 0E 2B 34 01 01 01 01 01 01 20 01 00 00 00 00"
   misb_tag = 10
   misb_units = "None"
+  misb_shared = True
 
   def __init__(self, value: str):
     self.value = str(value)
@@ -206,6 +220,7 @@ class ImageSourceSensorElement(Element, MISB_str):
   misb_key = "06 0E 2B 34 01 01 01 01 04 20 01 02 01 01 00 00"
   misb_tag = 11
   misb_units = "None"
+  misb_shared = True
 
   def __init__(self, value: str):
     self.value = str(value)
@@ -220,6 +235,7 @@ class ImageCoordinateSystemElement(Element, MISB_str):
   misb_key = "06 0E 2B 34 01 01 01 01 07 01 01 01 00 00 00 00"
   misb_tag = 12
   misb_units = "None"
+  misb_shared = True
 
   def __init__(self, value: str):
     self.value = str(value)
@@ -509,6 +525,8 @@ class UASLocalSetVersionElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 02 03 03 00 00 00"
   misb_tag = 65
   misb_units = "None"
+  _width = 1
+  misb_shared = True
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -571,6 +589,7 @@ class SpeedElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 01 0A 00 00 00"
   misb_tag = 8
   misb_units = "Meters/Second"
+  _width = 1
 
   def __init__(self, value: float):
     self.value = float(value)
@@ -583,6 +602,7 @@ class PlatformTailNumberElement(Element, MISB_str):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 04 01 02 00 00 00"
   misb_tag = 4
   misb_units = "None"
+  misb_shared = True
 
   def __init__(self, value: str):
     self.value = str(value)
@@ -595,6 +615,7 @@ class PlatformIndicatedAirspeedElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 01 0B 00 00 00"
   misb_tag = 9
   misb_units = "Meters/Second"
+  _width = 1
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -820,6 +841,7 @@ class OutsideAirTemperatureElement(Element, MISB_int):
   misb_tag = 39
   misb_units = "Celsius"
   _signed = True
+  _width = 1
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -876,6 +898,7 @@ class TargetTrackGateWidthElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 03 05 00 00 00"
   misb_tag = 43
   misb_units = "Pixels"
+  _width = 1
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -892,6 +915,7 @@ class TargetTrackGateHeightElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 03 06 00 00 00"
   misb_tag = 44
   misb_units = "Pixels"
+  _width = 1
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -936,11 +960,13 @@ class GenericFlagDataElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 03 01 00 00 00"
   misb_tag = 47
   misb_units = "None"
+  _width = 1
 
   def __init__(self, value: int):
     self.value = int(value)
 
-class SecurityLocalSetElement(Element, MISB_0601):
+# MISB ST 0102
+class SecurityLocalSetElement(Element, MISB_LocalSet):
   name = "securityLocalSet"
   names = {"securityLocalSet"}
 
@@ -949,14 +975,8 @@ class SecurityLocalSetElement(Element, MISB_0601):
   misb_tag = 48
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
-
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
 class DifferentialPressureElement(Element, MISB_float):
   name = "differentialPressure"
@@ -1067,6 +1087,7 @@ class PlatformGroundSpeedElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 01 05 00 00 00"
   misb_tag = 56
   misb_units = "Meters/Second"
+  _width = 1
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -1107,6 +1128,7 @@ class PlatformCallSignElement(Element, MISB_str):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 04 01 01 00 00 00"
   misb_tag = 59
   misb_units = "None"
+  misb_shared = True
 
   def __init__(self, value: str):
     self.value = str(value)
@@ -1119,6 +1141,7 @@ class WeaponLoadElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 01 12 00 00 00"
   misb_tag = 60
   misb_units = "None"
+  _width = 2
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -1131,6 +1154,7 @@ class WeaponFiredElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 01 13 00 00 00"
   misb_tag = 61
   misb_units = "None"
+  _width = 1
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -1144,6 +1168,7 @@ class LaserPRFCodeElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 02 02 01 00 00 00"
   misb_tag = 62
   misb_units = "None"
+  _width = 2
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -1266,11 +1291,13 @@ class EventStartTimeUTCElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 07 02 01 02 07 01 00 00"
   misb_tag = 72
   misb_units = "Microseconds"
+  _width = 8
 
   def __init__(self, value: str):
     self.value = str(value)
 
-class RVTLocalSetElement(Element, MISB_0601):
+# MISB ST 0806
+class RVTLocalSetElement(Element, MISB_LocalSet):
   name = "RVTLocalSet"
   names = {"RVTLocalSet"}
 
@@ -1279,17 +1306,11 @@ class RVTLocalSetElement(Element, MISB_0601):
   misb_tag = 73
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
-
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # MISB ST 0806
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
-class VMTILocalSetElement(Element, MISB_0601):
+# MISB ST 0903
+class VMTILocalSetElement(Element, MISB_LocalSet):
   name = "VMTILocalSet"
   names = {"VMTILocalSet"}
 
@@ -1298,15 +1319,31 @@ class VMTILocalSetElement(Element, MISB_0601):
   misb_tag = 74
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # MISB ST 0903
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  vtarget_series_tag = 101
+
+  # (target ID, LocalSetView of the target's VTarget Pack) for each target in
+  # the VTarget Series. Only the target IDs are read to build the list
+  def targets(self) -> List[Tuple[int, LocalSetView]]:
+    if self.vtarget_series_tag not in self.value:
+      return []
+
+    targets = []
+    for pack in self.value.series(self.vtarget_series_tag):
+      # Each pack starts with its BER-OID target ID
+      target_id = 0
+      pos = 0
+      while pos < len(pack):
+        byte = pack[pos]
+        pos += 1
+        target_id = (target_id << 7) + (byte & 0x7F)
+        if byte < 128:
+          break
+      targets.append((target_id, LocalSetView(pack[pos:])))
+
+    return targets
 
 class AlternatePlatformEllipsoidHeightElement(Element, MISB_float):
   name = "alternatePlatformEllipsoidHeight"
@@ -1562,7 +1599,8 @@ class MIISCoreIdentifierElement(Element, MISB_0601):
     # to have its own special procedures because it's a fancy boi
     pass
 
-class SARMotionImageryLocalSetElement(Element, MISB_0601):
+# MISB 1206
+class SARMotionImageryLocalSetElement(Element, MISB_LocalSet):
   name = "SARMotionImageryLocalSet"
   names = {"SARMotionImageryLocalSet"}
 
@@ -1571,17 +1609,11 @@ class SARMotionImageryLocalSetElement(Element, MISB_0601):
   misb_tag = 95
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
-
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # MISB 1206
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
-class RangeImageLocalSetElement(Element, MISB_0601):
+# MISB 1002
+class RangeImageLocalSetElement(Element, MISB_LocalSet):
   name = "rangeImageLocalSet"
   names = {"rangeImageLocalSet"}
 
@@ -1590,17 +1622,11 @@ class RangeImageLocalSetElement(Element, MISB_0601):
   misb_tag = 97
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
-
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # MISB 1002
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
-class GeoRegistrationLocalSetElement(Element, MISB_0601):
+# MISB 1601
+class GeoRegistrationLocalSetElement(Element, MISB_LocalSet):
   name = "geoRegistrationLocalSet"
   names = {"geoRegistrationLocalSet"}
 
@@ -1609,17 +1635,11 @@ class GeoRegistrationLocalSetElement(Element, MISB_0601):
   misb_tag = 98
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
-
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # MISB 1601
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
-class CompositeImagingLocalSetElement(Element, MISB_0601):
+# MISB 1602
+class CompositeImagingLocalSetElement(Element, MISB_LocalSet):
   name = "compositeImagingLocalSet"
   names = {"compositeImagingLocalSet"}
 
@@ -1628,17 +1648,11 @@ class CompositeImagingLocalSetElement(Element, MISB_0601):
   misb_tag = 99
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
-
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # MISB 1602
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
-class SegmentLocalSetElement(Element, MISB_0601):
+# MISB 1607
+class SegmentLocalSetElement(Element, MISB_LocalSet):
   name = "segmentLocalSet"
   names = {"segmentLocalSet"}
 
@@ -1647,17 +1661,11 @@ class SegmentLocalSetElement(Element, MISB_0601):
   misb_tag = 100
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
-
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # MISB 1607
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
-class AmendLocalSetElement(Element, MISB_0601):
+# MISB 1607
+class AmendLocalSetElement(Element, MISB_LocalSet):
   name = "amendLocalSet"
   names = {"amendLocalSet"}
 
@@ -1666,15 +1674,8 @@ class AmendLocalSetElement(Element, MISB_0601):
   misb_tag = 101
   misb_units = "None"
 
-  def __init__(self, value: str):
-    self.value = str(value)
-
-  @classmethod
-  def fromMISB(cls, value: bytes):
-    # MISB 1607
-    # This contains elements from a different standard so this will have
-    # to have its own special procedures because it's a fancy boi
-    pass
+  def __init__(self, value: LocalSetView):
+    self.value = value
 
 class SDCCFLPElement(Element, MISB_0601):
   name = "SDCCFLP"
@@ -1999,6 +2000,7 @@ class NumNAVSATSinViewElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 02 0A 00 00 00"
   misb_tag = 123
   misb_units = "Count"
+  _width = 1
 
   def __init__(self, value: int):
     self.value = int(value)
@@ -2011,6 +2013,7 @@ class PositioningMethodSourceElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 02 0A 0E 00 00"
   misb_tag = 124
   misb_units = "None"
+  _width = 1
   _code = { 0 : "INS",
             1 : "GPS", 
             2 : "Galileo",
@@ -2034,6 +2037,7 @@ class PlatformStatusElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 01 37 00 00 00"
   misb_tag = 125
   misb_units = "None"
+  _width = 1
   _code = { 0  : "Active",
             1  : "Pre-flight", 
             2  : "Pre-flight-taxiing",
@@ -2059,6 +2063,7 @@ class SensorControlModeElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 02 0A 0F 00 00"
   misb_tag = 126
   misb_units = "None"
+  _width = 1
   _code = { 0  : "Off",
             1  : "Home Position", 
             2  : "Uncontrolled",
@@ -2185,6 +2190,7 @@ class TakeoffTimeElement(Element, MISB_int):
   misb_key = "06 0E 2B 34 01 01 01 01 0E 01 01 01 38 00 00 00"
   misb_tag = 131
   misb_units = "Microseconds"
+  _width = 8
 
   def __init__(self, value: int):
     self.value = value
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+# Reads the stream metadata detection needs straight out of the boxes of an
+# ISO base media file (MP4/MOV) instead of running ffprobe on it
+# Only the top level box headers and the moov box are read
+
+import logging
+import os
+import struct
+from datetime import datetime, timezone
+from typing import BinaryIO, Dict, Iterator, List, Tuple, Union
+
+JSONType = Dict[str, Union[List[Dict[str, Union[str, int]]], Dict[str,Union[str, int]]]]
+logger = logging.getLogger("OTK.isobmff")
+
+# Box types that may come first in a file this reader understands
+_TOP_LEVEL = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pnot", b"uuid"}
+
+# Seconds between the MP4 epoch (1904-01-01) and the Unix epoch
+_MP4_EPOCH_OFFSET = 2082844800
+
+# hdlr handler type -> ffprobe codec_type
+_CODEC_TYPES = {b"vide" : "video",
+                b"soun" : "audio",
+                b"text" : "subtitle",
+                b"sbtl" : "subtitle",
+                b"subt" : "subtitle",
+                b"clcp" : "subtitle"}
+
+# True if head (the start of a file) looks like the first box of an MP4/MOV
+def is_isobmff(head: bytes) -> bool:
+  return len(head) >= 8 and head[4:8] in _TOP_LEVEL
+
+# Yields (type, body_start, box_end) for each box in data[pos:end]
+def _boxes(data: bytes, pos: int, end: int) -> Iterator[Tuple[bytes, int, int]]:
+  while pos + 8 <= end:
+    size, box_type = struct.unpack_from(">I4s", data, pos)
+    body_start = pos + 8
+    if size == 1:
+      if pos + 16 > end:
+        return
+      size = struct.unpack_from(">Q", data, pos + 8)[0]
+      body_start = pos + 16
+    elif size == 0:
+      size = end - pos
+    if size < body_start - pos or pos + size > end:
+      return
+    yield box_type, body_start, pos + size
+    pos += size
+
+def _find(data: bytes, pos: int, end: int, box_type: bytes) -> Tuple[int, int]:
+  for found, body_start, box_end in _boxes(data, pos, end):
+    if found == box_type:
+      return body_start, box_end
+  return None
+
+# Finds the moov box by stepping over the top level box headers, so large
+# mdat boxes are never read
+def _read_moov(fl: BinaryIO, file_size: int) -> bytes:
+  pos = 0
+  first = True
+  while pos + 8 <= file_size:
+    fl.seek(pos)
+    header = fl.read(16)
+    if len(header) < 8:
+      return None
+    size, box_type = struct.unpack_from(">I4s", header)
+    if first and not is_isobmff(header):
+      return None
+    first = False
+
+    header_size = 8
+    if size == 1:
+      if len(header) < 16:
+        return None
+      size = struct.unpack_from(">Q", header, 8)[0]
+      header_size = 16
+    elif size == 0:
+      size = file_size - pos
+    if size < header_size:
+      return None
+
+    if box_type == b"moov":
+      fl.seek(pos)
+      moov = fl.read(size)
+      return moov if len(moov) == size else None
+    pos += size
+
+  return None
+
+# Reads (creation time, timescale, duration) from the body of an mvhd or mdhd
+def _read_header(data: bytes, pos: int) -> Tuple[int, int, int]:
+  if data[pos] == 1:
+    created, _, timescale, duration = struct.unpack_from(">QQIQ", data, pos + 4)
+  else:
+    created, _, timescale, duration = struct.unpack_from(">IIII", data, pos + 4)
+  return created, timescale, duration
+
+def _creation_time(created: int) -> str:
+  # Same format as ffprobe
+  if created == 0:
+    return None
+  stamp = datetime.fromtimestamp(created - _MP4_EPOCH_OFFSET, tz=timezone.utc)
+  return stamp.strftime("%Y-%m-%dT%H:%M:%S.000000Z")
+
+def _duration(timescale: int, duration: int) -> str:
+  if timescale == 0:
+    return None
+  return "{:.6f}".format(duration / timescale)
+
+# Same as ffprobe's rendering of a fourcc
+def _fourcc_string(fourcc: bytes) -> str:
+  return "".join(chr(byte) if chr(byte).isalnum() or chr(byte) in ". _" else "[{}]".format(byte)
+                 for byte in fourcc)
+
+def _read_stream(moov: bytes, body_start: int, box_end: int, index: int) -> Dict:
+  stream = {"index" : index, "codec_type" : "data", "tags" : {}}
+  fourcc = b"\x00\x00\x00\x00"
+
+  mdia = _find(moov, body_start, box_end, b"mdia")
+  if mdia is not None:
+    for box_type, start, end in _boxes(moov, mdia[0], mdia[1]):
+      if box_type == b"mdhd":
+        created, timescale, duration = _read_header(moov, start)
+        creation_time = _creation_time(created)
+        if creation_time:
+          stream["tags"]["creation_time"] = creation_time
+        stream_duration = _duration(timescale, duration)
+        if stream_duration:
+          stream["duration"] = stream_duration
+      elif box_type == b"hdlr":
+        handler = moov[start+8 : start+12]
+        stream["codec_type"] = _CODEC_TYPES.get(handler, "data")
+      elif box_type == b"minf":
+        stbl = _find(moov, start, end, b"stbl")
+        stsd = _find(moov, stbl[0], stbl[1], b"stsd") if stbl is not None else None
+        # Version/flags and entry count come before the first sample entry
+        if stsd is not None and stsd[0] + 16 <= stsd[1]:
+          fourcc = moov[stsd[0]+12 : stsd[0]+16]
+
+  stream["codec_tag_string"] = _fourcc_string(fourcc)
+  # ffprobe reports the tag as a little endian int, e.g. "avc1" is 0x31637661
+  stream["codec_tag"] = "0x{:08x}".format(struct.unpack("<I", fourcc)[0])
+  return stream
+
+# Returns the subset of ffprobe's -show_format -show_streams output that
+# detection and splitting use, or None if src isn't an MP4/MOV this can read
+def read_metadata(src: str) -> JSONType:
+  try:
+    with open(src, "rb") as fl:
+      moov = _read_moov(fl, os.fstat(fl.fileno()).st_size)
+  except OSError:
+    return None
+  if moov is None:
+    return None
+
+  try:
+    metadata = {"streams" : [], "format" : {"format_name" : "mov,mp4,m4a,3gp,3g2,mj2", "tags" : {}}}
+    moov_start = 16 if struct.unpack_from(">I", moov)[0] == 1 else 8
+    for box_type, start, end in _boxes(moov, moov_start, len(moov)):
+      if box_type == b"mvhd":
+        created, timescale, duration = _read_header(moov, start)
+        creation_time = _creation_time(created)
+        if creation_time:
+          metadata["format"]["tags"]["creation_time"] = creation_time
+        file_duration = _duration(timescale, duration)
+        if file_duration:
+          metadata["format"]["duration"] = file_duration
+      elif box_type == b"trak":
+        metadata["streams"].append(_read_stream(moov, start, end, len(metadata["streams"])))
+  except (struct.error, IndexError, ValueError, OverflowError) as e:
+    logger.info("Could not read the boxes of {}: {}".format(src, e))
+    return None
+
+  return metadata
+
+# Sample entry formats of the text tracks read_text_samples understands. Both
+# store each sample as a 16-bit length followed by the text
+_TEXT_FORMATS = {b"tx3g", b"text"}
+
+# Returns the start and end time (in track timescale units) of each sample from an stts box
+def _sample_times(data: bytes, pos: int) -> List[Tuple[int, int]]:
+  times = []
+  time = 0
+  entry_count = struct.unpack_from(">I", data, pos + 4)[0]
+  for count, delta in struct.iter_unpack(">II", data[pos+8 : pos+8+8*entry_count]):
+    for _ in range(count):
+      times.append((time, time + delta))
+      time += delta
+  return times
+
+def _sample_sizes(data: bytes, pos: int) -> List[int]:
+  sample_size, sample_count = struct.unpack_from(">II", data, pos + 4)
+  if sample_size != 0:
+    return [sample_size] * sample_count
+  return list(struct.unpack_from(">{}I".format(sample_count), data, pos + 12))
+
+def _chunk_offsets(data: bytes, pos: int, large: bool) -> List[int]:
+  entry_count = struct.unpack_from(">I", data, pos + 4)[0]
+  return list(struct.unpack_from(">{}{}".format(entry_count, "Q" if large else "I"), data, pos + 8))
+
+# Number of samples in each chunk from an stsc box
+def _samples_per_chunk(data: bytes, pos: int, num_chunks: int) -> List[int]:
+  entry_count = struct.unpack_from(">I", data, pos + 4)[0]
+  runs = list(struct.iter_unpack(">III", data[pos+8 : pos+8+12*entry_count]))
+  counts = []
+  for idx, (first_chunk, samples, _) in enumerate(runs):
+    last_chunk = runs[idx+1][0] if idx + 1 < len(runs) else num_chunks + 1
+    counts.extend([samples] * (last_chunk - first_chunk))
+  return counts[:num_chunks]
+
+def _decode_text(sample: bytes) -> str:
+  if len(sample) < 2:
+    return ""
+  length = struct.unpack_from(">H", sample)[0]
+  text = sample[2 : 2+length]
+  if text.startswith(b"\xfe\xff"):
+    return text.decode("utf-16", errors="replace")
+  return text.decode("utf-8", errors="replace")
+
+# The sample tables (as box offsets in moov) and timescale of the first
+# subtitle track with a text sample format, or None if there isn't one
+def _find_text_track(moov: bytes) -> Tuple[Dict[bytes, Tuple[int, int]], int]:
+  moov_start = 16 if struct.unpack_from(">I", moov)[0] == 1 else 8
+  for box_type, start, end in _boxes(moov, moov_start, len(moov)):
+    if box_type != b"trak":
+      continue
+    mdia = _find(moov, start, end, b"mdia")
+    if mdia is None:
+      continue
+
+    tables = {}
+    timescale = 0
+    handler = None
+    for mdia_type, mdia_start, mdia_end in _boxes(moov, mdia[0], mdia[1]):
+      if mdia_type == b"mdhd":
+        _, timescale, _ = _read_header(moov, mdia_start)
+      elif mdia_type == b"hdlr":
+        handler = moov[mdia_start+8 : mdia_start+12]
+      elif mdia_type == b"minf":
+        stbl = _find(moov, mdia_start, mdia_end, b"stbl")
+        if stbl is not None:
+          for stbl_type, stbl_start, stbl_end in _boxes(moov, stbl[0], stbl[1]):
+            tables[stbl_type] = (stbl_start, stbl_end)
+
+    if _CODEC_TYPES.get(handler) != "subtitle" or timescale == 0 or b"stsd" not in tables:
+      continue
+    stsd = tables[b"stsd"][0]
+    if moov[stsd+12 : stsd+16] in _TEXT_FORMATS:
+      return tables, timescale
+
+  return None
+
+# Returns (start, end, text) for each sample of the first text subtitle track
+# (e.g. the telemetry track DJI embeds), with times in seconds. Samples are
+# read straight from the file using the track's sample tables. Returns None
+# if src isn't an MP4/MOV or has no such track
+def read_text_samples(src: str) -> List[Tuple[float, float, str]]:
+  try:
+    with open(src, "rb") as fl:
+      moov = _read_moov(fl, os.fstat(fl.fileno()).st_size)
+      if moov is None:
+        return None
+
+      track = _find_text_track(moov)
+      if track is None:
+        return None
+      tables, timescale = track
+      if b"stts" not in tables or b"stsz" not in tables or b"stsc" not in tables:
+        return None
+
+      times = _sample_times(moov, tables[b"stts"][0])
+      sizes = _sample_sizes(moov, tables[b"stsz"][0])
+      if b"co64" in tables:
+        offsets = _chunk_offsets(moov, tables[b"co64"][0], True)
+      elif b"stco" in tables:
+        offsets = _chunk_offsets(moov, tables[b"stco"][0], False)
+      else:
+        return None
+      per_chunk = _samples_per_chunk(moov, tables[b"stsc"][0], len(offsets))
+
+      samples = []
+      sample = 0
+      # A chunk's samples are stored back to back so each chunk takes one read
+      for offset, count in zip(offsets, per_chunk):
+        chunk_sizes = sizes[sample : sample + count]
+        fl.seek(offset)
+        chunk = fl.read(sum(chunk_sizes))
+        pos = 0
+        for size in chunk_sizes:
+          if sample >= len(times):
+            break
+          text = _decode_text(chunk[pos : pos + size])
+          if text:
+            start, end = times[sample]
+            samples.append((start / timescale, end / timescale, text))
+          pos += size
+          sample += 1
+  except (OSError, struct.error, IndexError, ValueError, OverflowError) as e:
+    logger.info("Could not read the text track of {}: {}".format(src, e))
+    return None
+
+  return samples
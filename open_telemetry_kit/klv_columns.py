@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+from .telemetry import Telemetry
+from .packet import Packet
+from .elements import TimestampElement
+from .misb_0601 import MISB_int, MISB_float
+
+import numpy as np
+from typing import Dict, List, Tuple
+
+# True if a MISB element class decodes to a single number and so can be
+# stored as a column
+def is_numeric(cls) -> bool:
+  if cls is TimestampElement:
+    return True
+  elif issubclass(cls, MISB_float):
+    return cls.fromMISB.__func__ is MISB_float.fromMISB.__func__
+  elif issubclass(cls, MISB_int):
+    return cls.fromMISB.__func__ is MISB_int.fromMISB.__func__
+  return False
+
+# Converts an (n, length) uint8 array of big endian integers to n integers
+def _raw_to_int(raw: np.ndarray, signed: bool) -> np.ndarray:
+  length = raw.shape[1]
+  if length in (1, 2, 4, 8):
+    dtype = np.dtype(">{}{}".format("i" if signed else "u", length))
+    return np.ascontiguousarray(raw).view(dtype).reshape(-1)
+
+  vals = np.zeros(len(raw), dtype=np.int64)
+  for col in range(length):
+    vals = (vals << 8) | raw[:, col]
+  if signed:
+    vals = np.where(vals >= 2**(8*length - 1), vals - 2**(8*length), vals)
+  return vals
+
+class KLVColumns:
+  # columns: key -> array with one entry per packet
+  # masks: key -> bool array, True where the packet held a valid value
+  # element_classes: key -> Element class the column was decoded as
+  def __init__(self, num_packets: int,
+               columns: Dict[str, np.ndarray],
+               masks: Dict[str, np.ndarray],
+               element_classes: Dict[str, type]):
+    self.num_packets = num_packets
+    self.columns = columns
+    self.masks = masks
+    self.element_classes = element_classes
+
+  def __len__(self) -> int:
+    return self.num_packets
+
+  def __getitem__(self, key: str) -> np.ndarray:
+    return self.columns[key]
+
+  def __contains__(self, key: str) -> bool:
+    return key in self.columns
+
+  def keys(self):
+    return self.columns.keys()
+
+  # Builds the equivalent Telemetry for the decoded columns. Only the
+  # columns (and only the valid entries) are included
+  def to_telemetry(self) -> Telemetry:
+    tel = Telemetry()
+    for idx in range(self.num_packets):
+      packet = Packet()
+      for key, column in self.columns.items():
+        if self.masks[key][idx]:
+          cls = self.element_classes[key]
+          if cls is TimestampElement:
+            element = TimestampElement(0).to_microseconds()
+            element.value = int(column[idx])
+          elif issubclass(cls, MISB_float):
+            element = cls(float(column[idx]))
+          else:
+            element = cls(int(column[idx]))
+          packet.data[key] = element
+      tel.append(packet)
+
+    return tel
+
+# Gathers raw values for a set of tags across packets into one contiguous
+# buffer per (tag, length) and decodes each buffer in a single NumPy pass
+class KLVColumnCollector:
+  # columns: MISB tag -> (column key, Element class)
+  # drop_missing: leave out columns for tags that never appear
+  def __init__(self, columns: Dict[int, Tuple[str, type]], drop_missing: bool = False):
+    self.columns = columns
+    self.drop_missing = drop_missing
+    self.raw = {}
+    self.rows = {}
+    self.num_packets = 0
+
+  def add(self, buf: memoryview, fields: List[Tuple[int, int, int]]):
+    row = self.num_packets
+    columns = self.columns
+    raw = self.raw
+    for tag, value_start, value_end in fields:
+      if tag in columns:
+        group = (tag, value_end - value_start)
+        if group not in raw:
+          raw[group] = bytearray()
+          self.rows[group] = []
+        raw[group] += buf[value_start : value_end]
+        self.rows[group].append(row)
+
+    self.num_packets += 1
+
+  def finish(self) -> KLVColumns:
+    columns = {}
+    masks = {}
+    element_classes = {}
+    present = {tag for tag, _ in self.raw}
+    for tag, (key, cls) in self.columns.items():
+      if self.drop_missing and tag not in present:
+        continue
+      element_classes[key] = cls
+      masks[key] = np.zeros(self.num_packets, dtype=bool)
+      if issubclass(cls, MISB_float):
+        columns[key] = np.full(self.num_packets, np.nan)
+      else:
+        columns[key] = np.zeros(self.num_packets, dtype=np.int64)
+
+    for (tag, length), raw in self.raw.items():
+      if length == 0 or length > 8:
+        # Not a width any of the numeric tags are encoded in. Leave masked
+        continue
+
+      key, cls = self.columns[tag]
+      rows = np.array(self.rows[(tag, length)], dtype=np.intp)
+      raw = np.frombuffer(bytes(raw), dtype=np.uint8).reshape(-1, length)
+      valid = np.ones(len(rows), dtype=bool)
+
+      if issubclass(cls, MISB_float):
+        width = length if cls._domain == 'IMAPB' else cls._width()
+        scale, offset, signed = cls._linear_map(width)
+        vals = _raw_to_int(raw, signed) * scale + offset
+        if isinstance(cls._invalid, bytes) and len(cls._invalid) == length:
+          invalid = np.frombuffer(cls._invalid, dtype=np.uint8)
+          valid = ~(raw == invalid).all(axis=1)
+          vals[~valid] = np.nan
+      else:
+        vals = _raw_to_int(raw, cls._signed is True)
+
+      columns[key][rows] = vals
+      masks[key][rows] = valid
+
+    return KLVColumns(self.num_packets, columns, masks, element_classes)
@@ -1,5 +1,10 @@
 from io import BytesIO
-from typing import Tuple
+from typing import List, Set, Tuple
+
+# Every SMPTE universal label starts with these bytes. Sets (groups) are
+# in category 2, the byte after it
+SMPTE_UL_PREFIX = bytes.fromhex("06 0E 2B 34")
+SMPTE_GROUP_PREFIX = bytes.fromhex("06 0E 2B 34 02")
 
 def lerp(x: int, x0: int, x1: int, y0: float, y1: float):
   t = (x - x0) / (x1 - x0)
@@ -13,7 +18,8 @@ def bytes_to_float(byte, src: Tuple[int, int], dest: Tuple[float, float]):
   return lerp(i, src[0], src[1], dest[0], dest[1])
 
 def bytes_to_str(byte):
-  return byte.decode("utf-8")
+  # str() rather than .decode() so memoryview slices are accepted as well
+  return str(byte, "utf-8")
 
 def read_len(klv_stream: BytesIO):
   length = bytes_to_int(klv_stream.read(1))
@@ -36,3 +42,180 @@ def read_ber_oid(klv_stream: BytesIO):
 
   val = (val << 7) + (byte)
   return val
+
+
+_short_lengths = [bytes([length]) for length in range(128)]
+
+# Inverse of read_len
+def write_len(length: int) -> bytes:
+  if length < 128:
+    return _short_lengths[length]
+  size = (length.bit_length() + 7) // 8
+  return bytes([128 + size]) + length.to_bytes(size, "big")
+
+# Inverse of read_ber_oid
+def write_ber_oid(val: int) -> bytes:
+  if val < 128:
+    return bytes([val])
+  out = [val & 0x7F]
+  val >>= 7
+  while val:
+    out.append(128 + (val & 0x7F))
+    val >>= 7
+  return bytes(reversed(out))
+
+# MISB 0601 running 16-bit checksum over buf[start:end]. Bytes are summed as
+# big endian 16-bit words, which is the same as weighting the even and odd
+# bytes separately. Both sums are done in C over strided views, so there's no
+# per-byte Python arithmetic
+def misb_checksum(buf: memoryview, start: int, end: int) -> int:
+  return ((sum(buf[start:end:2]) << 8) + sum(buf[start+1:end:2])) & 0xFFFF
+
+# Walks the tag/length/value triplets of a local set in buf[pos:end] by offset
+# Returns a (tag, value_start, value_end) for each or None if the set is malformed
+# If keep is given any tag not in it is stepped over by its length and left out
+def split_local_set(buf: memoryview, pos: int, end: int,
+                    keep: Set[int] = None) -> List[Tuple[int, int, int]]:
+  fields = []
+  while pos < end:
+    # BER-OID tag
+    tag = buf[pos]
+    pos += 1
+    if tag >= 128:
+      tag &= 0x7F
+      while pos < end:
+        tag_byte = buf[pos]
+        pos += 1
+        tag = (tag << 7) + (tag_byte & 0x7F)
+        if tag_byte < 128:
+          break
+
+    if pos >= end:
+      return None
+
+    # BER length
+    length = buf[pos]
+    pos += 1
+    if length >= 128:
+      len_end = pos + length - 128
+      length = int.from_bytes(buf[pos : len_end], "big")
+      pos = len_end
+
+    value_end = pos + length
+    if value_end > end:
+      return None
+
+    if keep is None or tag in keep:
+      fields.append((tag, pos, value_end))
+    pos = value_end
+
+  return fields
+
+# Reads a BER length at buf[pos] and returns (length, offset just past it)
+def _read_len_at(buf: memoryview, pos: int) -> Tuple[int, int]:
+  length = buf[pos]
+  pos += 1
+  if length >= 128:
+    len_end = pos + length - 128
+    length = int.from_bytes(buf[pos : len_end], "big")
+    pos = len_end
+  return length, pos
+
+# Zero copy view of a nested local set (e.g. Security, VMTI) in its parent's
+# buffer. Tags are only split out the first time the set is accessed and
+# values are only copied out when they're looked up
+class LocalSetView:
+  __slots__ = ("buf", "_fields")
+
+  def __init__(self, buf: memoryview):
+    self.buf = buf if isinstance(buf, memoryview) else memoryview(buf)
+    self._fields = None
+
+  # (tag, value_start, value_end) for each element, worked out on first use
+  def fields(self) -> List[Tuple[int, int, int]]:
+    if self._fields is None:
+      fields = split_local_set(self.buf, 0, len(self.buf))
+      if fields is None:
+        raise ValueError("Local set length does not match its contents")
+      self._fields = fields
+    return self._fields
+
+  # Raw value of the first element with this tag
+  def __getitem__(self, tag: int) -> bytes:
+    for field_tag, start, end in self.fields():
+      if field_tag == tag:
+        return bytes(self.buf[start : end])
+    raise KeyError(tag)
+
+  def get(self, tag: int, default: bytes = None) -> bytes:
+    try:
+      return self[tag]
+    except KeyError:
+      return default
+
+  # Raw values of every element with this tag, for tags that may repeat
+  def get_all(self, tag: int) -> List[bytes]:
+    return [bytes(self.buf[start : end]) for field_tag, start, end in self.fields()
+            if field_tag == tag]
+
+  # View of the value with this tag as a local set in its own right
+  def local_set(self, tag: int) -> 'LocalSetView':
+    for field_tag, start, end in self.fields():
+      if field_tag == tag:
+        return LocalSetView(self.buf[start : end])
+    raise KeyError(tag)
+
+  # Views of each pack in a series value (a run of BER length prefixed
+  # packs, e.g. the VMTI VTarget Series)
+  def series(self, tag: int) -> List[memoryview]:
+    for field_tag, start, end in self.fields():
+      if field_tag == tag:
+        break
+    else:
+      raise KeyError(tag)
+
+    packs = []
+    pos = start
+    while pos < end:
+      length, pos = _read_len_at(self.buf, pos)
+      if pos + length > end:
+        raise ValueError("Series length does not match its contents")
+      packs.append(self.buf[pos : pos + length])
+      pos += length
+    return packs
+
+  def __contains__(self, tag: int) -> bool:
+    return any(field_tag == tag for field_tag, _, _ in self.fields())
+
+  def __iter__(self):
+    return (tag for tag, _, _ in self.fields())
+
+  def __len__(self) -> int:
+    return len(self.fields())
+
+  def __bytes__(self) -> bytes:
+    return bytes(self.buf)
+
+  def __str__(self) -> str:
+    return self.buf.hex()
+
+  def __repr__(self) -> str:
+    return "LocalSetView({} bytes)".format(len(self.buf))
+
+  # Views into other buffers can't be pickled so send the bytes instead
+  def __reduce__(self):
+    return (LocalSetView, (bytes(self.buf),))
+
+  # Tag -> hex of the raw value. Repeated tags become lists
+  def toJson(self) -> dict:
+    out = {}
+    for tag, start, end in self.fields():
+      value = self.buf[start : end].hex()
+      key = str(tag)
+      if key not in out:
+        out[key] = value
+      elif isinstance(out[key], list):
+        out[key].append(value)
+      else:
+        out[key] = [out[key], value]
+    return out
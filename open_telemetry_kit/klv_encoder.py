@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+from .telemetry import Telemetry
+from .packet import Packet
+from .elements import TimestampElement, ChecksumElement
+from .misb_0601 import MISB_0601
+from .klv_common import write_len, write_ber_oid, misb_checksum
+
+import logging
+
+# MISB 0601 UAS Datalink Local Set
+UAS_LOCAL_SET_KEY = bytes.fromhex("06 0E 2B 34 02 0B 01 01 0E 01 03 01 01 00 00 00")
+
+# Encodes Telemetry back into MISB 0601 KLV. The inverse of KLVParser
+# Any Element of a MISB class with an encoder is written, whichever parser it
+# came from. Packets without a timestamp are skipped since the standard
+# requires one first, and every packet gets a freshly computed checksum
+class KLVEncoder:
+  def __init__(self):
+    self.logger = logging.getLogger("OTK.KLVEncoder")
+    # Element class -> (BER-OID tag, encoder)
+    self.encoders = {}
+    self._build_dict(MISB_0601)
+    del self.encoders[ChecksumElement]
+    self._unsupported = set()
+
+  def _build_dict(self, cls):
+    for subcls in cls.__subclasses__():
+      if isinstance(subcls.misb_tag, int):
+        encode = subcls.encoder()
+        if encode is not None:
+          self.encoders[subcls] = (write_ber_oid(subcls.misb_tag), encode)
+
+      self._build_dict(subcls)
+
+  # Encodes every packet into a single bytearray. All values are encoded
+  # first so the output can be allocated once at its final size
+  def encode(self, tel: Telemetry) -> bytearray:
+    encoded = []
+    total = 0
+    for packet in tel:
+      fields = self._encode_fields(packet)
+      if fields is None:
+        continue
+      # + 4 for the checksum's tag, length and value
+      body_len = len(fields) + 4
+      len_bytes = write_len(body_len)
+      total += len(UAS_LOCAL_SET_KEY) + len(len_bytes) + body_len
+      encoded.append((len_bytes, fields))
+
+    out = bytearray(total)
+    view = memoryview(out)
+    pos = 0
+    for len_bytes, fields in encoded:
+      start = pos
+      for part in (UAS_LOCAL_SET_KEY, len_bytes, fields, b"\x01\x02"):
+        view[pos : pos+len(part)] = part
+        pos += len(part)
+      checksum = misb_checksum(view, start, pos)
+      out[pos] = checksum >> 8
+      out[pos+1] = checksum & 0xFF
+      pos += 2
+
+    return out
+
+  def encode_packet(self, packet: Packet) -> bytes:
+    return bytes(self.encode([packet]))
+
+  # Returns the packet's encoded tag/length/value triplets, timestamp first,
+  # or None if it doesn't have a timestamp
+  def _encode_fields(self, packet: Packet) -> bytes:
+    encoders = self.encoders
+    timestamp = None
+    parts = []
+    for element in packet.values():
+      cls = element.__class__
+      if cls not in encoders:
+        self._warn_unsupported(cls)
+        continue
+
+      tag, encode = encoders[cls]
+      try:
+        value = encode(element)
+      except (TypeError, ValueError):
+        self._warn_unsupported(cls)
+        continue
+
+      if cls is TimestampElement:
+        timestamp = tag + write_len(len(value)) + value
+      else:
+        parts.append(tag)
+        parts.append(write_len(len(value)))
+        parts.append(value)
+
+    if timestamp is None:
+      self.logger.warn("Packet has no timestamp. Skipping Packet...")
+      return None
+
+    return timestamp + b"".join(parts)
+
+  def _warn_unsupported(self, cls: type):
+    if cls not in self._unsupported and cls is not ChecksumElement:
+      self._unsupported.add(cls)
+      self.logger.warn("Can't encode {} as KLV. Leaving it out".format(cls.__name__))
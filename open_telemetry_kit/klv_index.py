@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+from .telemetry import Telemetry
+from .packet import Packet
+from .elements import TimestampElement
+
+from array import array
+from bisect import bisect_left, bisect_right
+import logging
+from typing import Tuple
+
+logger = logging.getLogger("OTK.klv_index")
+
+# Time index over a KLV stream. Holds each packet's Precision Time Stamp and
+# where its body sits in the stream so packets in a time window can be found
+# by binary search and decoded on their own. Times are POSIX seconds, the
+# same as TimestampElement.to_seconds()
+class KLVIndex:
+  # parser: KLVParser used to decode the packets
+  # data: The KLV stream. Kept alive for as long as the index is
+  # times: Precision Time Stamp of each packet in microseconds, ascending
+  # starts, ends: Offsets of each packet's body in data
+  def __init__(self, parser, data: bytes, times: array, starts: array, ends: array):
+    self.parser = parser
+    self.data = data
+    self.buf = memoryview(data)
+    self.times = times
+    self.starts = starts
+    self.ends = ends
+
+  # One pass over data that reads only the key, length and timestamp of each
+  # packet. Packets are ordered by time if the stream wasn't already
+  @classmethod
+  def build(cls, parser, data: bytes) -> 'KLVIndex':
+    times = array("Q")
+    starts = array("Q")
+    ends = array("Q")
+    timestamp_tag = TimestampElement.misb_tag
+
+    def index_packet(buf: memoryview, pos: int, packet_end: int):
+      # Per MISB 0601 the timestamp is the first element and is 8 bytes long
+      if packet_end - pos < 10 or buf[pos] != timestamp_tag or buf[pos+1] != 8:
+        logger.warn("First element in packet was not Timestamp. Skipping Packet...")
+        return None
+      times.append(int.from_bytes(buf[pos+2 : pos+10], "big"))
+      starts.append(pos)
+      ends.append(packet_end)
+      return True
+
+    parser._reset_counters()
+    packets = parser._parse_buffer(data, 0, len(data), index_packet, final=True)
+    for _ in packets:
+      pass
+    parser._log_counters()
+
+    if any(times[idx] > times[idx+1] for idx in range(len(times) - 1)):
+      logger.warn("Timestamps are out of order. Sorting the index by time")
+      order = sorted(range(len(times)), key=times.__getitem__)
+      times = array("Q", (times[idx] for idx in order))
+      starts = array("Q", (starts[idx] for idx in order))
+      ends = array("Q", (ends[idx] for idx in order))
+
+    return cls(parser, data, times, starts, ends)
+
+  # Serialized form of the times and offsets for the cache
+  def to_bytes(self) -> bytes:
+    return self.times.tobytes() + self.starts.tobytes() + self.ends.tobytes()
+
+  @classmethod
+  def from_bytes(cls, parser, data: bytes, raw: bytes) -> 'KLVIndex':
+    arrays = array("Q")
+    arrays.frombytes(raw)
+    count = len(arrays) // 3
+    return cls(parser, data, arrays[:count], arrays[count:2*count], arrays[2*count:])
+
+  def __len__(self) -> int:
+    return len(self.times)
+
+  # Seconds covered by the index as (first, last)
+  def time_span(self) -> Tuple[float, float]:
+    if not self.times:
+      return None
+    return (self.times[0] * 1e-6, self.times[-1] * 1e-6)
+
+  def packet(self, idx: int) -> Packet:
+    return self.parser._parse_misb_packet(self.buf, self.starts[idx], self.ends[idx])
+
+  # Returns the first packet at or after t, or None if there isn't one
+  def seek_time(self, t: float) -> Packet:
+    idx = bisect_left(self.times, self._to_micro(t))
+    if idx == len(self.times):
+      return None
+    return self.packet(idx)
+
+  # Decodes just the packets with t0 <= time <= t1
+  def range(self, t0: float, t1: float) -> Telemetry:
+    beg = bisect_left(self.times, self._to_micro(t0))
+    end = bisect_right(self.times, self._to_micro(t1))
+    tel = Telemetry()
+    for idx in range(beg, end):
+      packet = self.packet(idx)
+      if packet is not None:
+        tel.append(packet)
+    return tel
+
+  def _to_micro(self, t: float) -> int:
+    return int(round(t * 1e6))
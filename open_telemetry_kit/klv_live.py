@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# asyncio ingest of live KLV feeds sent over UDP, either as MPEG-TS or as raw
+# KLV datagrams. Each feed is parsed incrementally as datagrams arrive and its
+# Packets are handed out through an async iterator. Many feeds can share one
+# event loop
+#
+# >>> async with await open_udp_feed(("0.0.0.0", 15000)) as feed:
+# ...   async for packet in feed:
+# ...     print(packet)
+
+from .klvparser import KLVParser, _drain
+from .mpegts import TSDemuxer, SYNC_BYTE
+from .packet import Packet
+
+import asyncio
+import logging
+from typing import Tuple
+
+logger = logging.getLogger("OTK.klv_live")
+
+class KLVFeed(asyncio.DatagramProtocol):
+  # parser: KLVParser configured for the feed (tags, lazy, checksum, ...).
+  #   Defaults to one with default options
+  # max_packets: Parsed Packets buffered before reading from the socket is
+  #   paused. While paused the kernel socket buffer absorbs the backlog
+  # mpegts: Whether datagrams are MPEG-TS or raw KLV. By default this is
+  #   decided by the first datagram received
+  def __init__(self, parser: KLVParser = None,
+               max_packets: int = 1024,
+               mpegts: bool = None):
+    self.parser = parser if parser is not None else KLVParser("udp")
+    self.max_packets = max_packets
+    self.mpegts = mpegts
+    self.transport = None
+    self.packets_dropped = 0
+    self._demuxer = TSDemuxer()
+    self._buf = b""
+    self._queue = asyncio.Queue()
+    self._paused = False
+    self._can_pause = False
+    self._closed = False
+
+  def connection_made(self, transport: asyncio.DatagramTransport):
+    self.transport = transport
+    # UDP transports only support pausing from Python 3.7 on
+    self._can_pause = hasattr(transport, "pause_reading")
+
+  def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+    if self._closed:
+      return
+    if self.mpegts is None:
+      self.mpegts = data[0] == SYNC_BYTE
+
+    units = self._demuxer.feed(data) if self.mpegts else [(None, data)]
+    parser = self.parser
+    for pts, klv in units:
+      self._buf += klv
+      packets = parser._parse_buffer(self._buf, 0, len(self._buf))
+      if self.mpegts:
+        packets = parser._set_pts(packets, pts)
+      pos = _drain(packets, self._put)
+      self._buf = self._buf[pos:]
+
+  def error_received(self, exc: Exception):
+    logger.warn("Error on KLV feed: {}".format(exc))
+
+  def connection_lost(self, exc: Exception):
+    self._closed = True
+    self._queue.put_nowait(None)
+
+  def _put(self, packet: Packet):
+    if self._queue.qsize() >= self.max_packets and not self._can_pause:
+      self.packets_dropped += 1
+      return
+
+    self._queue.put_nowait(packet)
+    if not self._paused and self._queue.qsize() >= self.max_packets:
+      self._paused = True
+      if self._can_pause:
+        self.transport.pause_reading()
+      else:
+        logger.warn("Transport can't pause reading. Dropping packets until the consumer catches up")
+
+  # Returns the next Packet or None once the feed is closed
+  async def get(self) -> Packet:
+    if self._closed and self._queue.empty():
+      return None
+
+    packet = await self._queue.get()
+    if packet is None:
+      # Leave the marker for any other consumers
+      self._queue.put_nowait(None)
+      return None
+
+    # Resume once the consumer has drained half the queue
+    if self._paused and self._queue.qsize() <= self.max_packets // 2:
+      self._paused = False
+      if self._can_pause:
+        self.transport.resume_reading()
+
+    return packet
+
+  def close(self):
+    if self.transport is not None:
+      self.transport.close()
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self) -> Packet:
+    packet = await self.get()
+    if packet is None:
+      raise StopAsyncIteration
+    return packet
+
+  async def __aenter__(self) -> 'KLVFeed':
+    return self
+
+  async def __aexit__(self, *exc):
+    self.close()
+
+# Binds a UDP socket to local_addr and returns the KLVFeed reading from it
+# Multicast groups must be joined on the socket by the caller (sock=...)
+async def open_udp_feed(local_addr: Tuple[str, int] = None,
+                        parser: KLVParser = None,
+                        max_packets: int = 1024,
+                        mpegts: bool = None,
+                        **kwargs) -> KLVFeed:
+  loop = asyncio.get_event_loop()
+  _, feed = await loop.create_datagram_endpoint(lambda: KLVFeed(parser, max_packets, mpegts),
+                                                local_addr=local_addr, **kwargs)
+  return feed
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+from .klvparser import KLVParser
+from .telemetry import Telemetry
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import mmap
+import os
+import pickle
+from typing import List, Tuple
+
+logger = logging.getLogger("OTK.klv_parallel")
+
+# Each chunk is small enough that the workers stay evenly loaded even when
+# some parts of the recording are denser than others
+CHUNKS_PER_WORKER = 4
+MIN_CHUNK_SIZE = 2**20
+
+# One parser per worker process and configuration, built on first use
+_worker_parsers = {}
+
+def _worker_parser(config: Tuple) -> KLVParser:
+  if config not in _worker_parsers:
+    options = dict(config)
+    cls = options.pop("cls")
+    keys = dict(options.pop("keys"))
+    uas_sets = set(options.pop("uas_sets"))
+    set_parsers = dict(options.pop("set_parsers"))
+
+    parser = cls("", **options)
+    # Sets registered at runtime only exist in the parent, so the registry is
+    # sent along rather than taken from the class
+    parser.keys = keys
+    parser.key_prefix = os.path.commonprefix(list(keys))
+    parser.uas_sets = uas_sets
+    parser.set_parsers = set_parsers
+    _worker_parsers[config] = parser
+  return _worker_parsers[config]
+
+# Hashable form of the parser class, its set registry and the options a
+# worker needs to rebuild the parser with. Set parsers have to be picklable
+# (e.g. module level functions)
+def _parser_config(parser: KLVParser) -> Tuple:
+  tags = frozenset(parser.tags) if parser.tags is not None else None
+  return (("cls", type(parser)),
+          ("keys", tuple(parser.keys.items())),
+          ("uas_sets", frozenset(parser.uas_sets)),
+          ("set_parsers", tuple(parser.set_parsers.items())),
+          ("use_misb_name", parser.use_misb_name),
+          ("tags", tags),
+          ("verify_checksum", parser.verify_checksum),
+          ("checksum_policy", parser.checksum_policy),
+          ("share_values", parser.share_values))
+
+# Runs in the worker. Maps the file (so the page cache is shared between all
+# workers instead of each getting a copy) and parses packets in [start, end)
+# The packets come back pickled. Some values (e.g. nested local sets) are
+# views into the map, so they're pickled before the map is closed
+def _parse_chunk(path: str, start: int, end: int, config: Tuple) -> Tuple[bytes, int, int, int, int]:
+  parser = _worker_parser(config)
+  parser._reset_counters()
+  with open(path, "rb") as fl:
+    with mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      tel = Telemetry()
+      packets = parser._parse_buffer(data, start, end, final=True)
+      pos = start
+      try:
+        while True:
+          tel.append(next(packets))
+      except StopIteration as stop:
+        pos = stop.value
+      del packets
+      pickled = pickle.dumps(tel.data, pickle.HIGHEST_PROTOCOL)
+      del tel
+
+  # Whatever is left can only be a partial packet at the very end of the file
+  return (pickled, parser.bytes_skipped + end - pos, parser.packets_dropped,
+          parser.checksum_failures, parser.sets_skipped)
+
+# Splits [0, size) into roughly equal chunks that each start on a packet
+def _split_chunks(parser: KLVParser, data: bytes, size: int, num_chunks: int) -> List[Tuple[int, int]]:
+  bounds = [0]
+  for idx in range(1, num_chunks):
+    start = parser._next_packet_start(data, max(size * idx // num_chunks, bounds[-1]), size)
+    if start > bounds[-1]:
+      bounds.append(start)
+  bounds.append(size)
+
+  return [(bounds[idx], bounds[idx+1]) for idx in range(len(bounds) - 1)
+          if bounds[idx] < bounds[idx+1]]
+
+# Parses a raw KLV file with a pool of worker processes
+# The parser supplies the configuration (use_misb_name, tags) and receives
+# the corruption counters. Packets come back in stream order
+def parse_file_parallel(parser: KLVParser, path: str, workers: int = None) -> Telemetry:
+  if parser.lazy:
+    logger.warn("Lazy packets can't be sent between processes. Decoding eagerly")
+
+  workers = workers or os.cpu_count() or 1
+  size = os.path.getsize(path)
+  tel = Telemetry()
+  parser._reset_counters()
+  if size == 0:
+    return tel
+
+  num_chunks = max(1, min(workers * CHUNKS_PER_WORKER, size // MIN_CHUNK_SIZE))
+  with open(path, "rb") as fl:
+    with mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      chunks = _split_chunks(parser, data, size, num_chunks)
+
+  config = _parser_config(parser)
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    futures = [executor.submit(_parse_chunk, path, start, end, config)
+               for start, end in chunks]
+    for future in futures:
+      packets, bytes_skipped, packets_dropped, checksum_failures, sets_skipped = future.result()
+      tel.extend(pickle.loads(packets))
+      parser.bytes_skipped += bytes_skipped
+      parser.packets_dropped += packets_dropped
+      parser.checksum_failures += checksum_failures
+      parser.sets_skipped += sets_skipped
+
+  parser._log_counters()
+  return tel
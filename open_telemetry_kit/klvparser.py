@@ -1,129 +1,660 @@
 from .parser import Parser
 from .telemetry import Telemetry
-from .packet import Packet
+from .packet import Packet, LazyPacket
 from .element import UnknownElement
 # from .elements import LatitudeElement, LongitudeElement, AltitudeElement
 from .elements import TimestampElement, ChecksumElement
-from .misb_0601 import MISB_0601
-from .detector import read_video_metadata, read_klv
-from .klv_common import bytes_to_int
+from .misb_0601 import MISB_0601, shared_decoder
+from .detector import read_video_metadata, read_klv, open_klv_stream, extract_klv, split_path, RAW_KLV_EXTENSIONS
+from .klv_common import split_local_set, misb_checksum, SMPTE_UL_PREFIX, SMPTE_GROUP_PREFIX
+from .cache import get_cache
+from .mpegts import TSDemuxer, TS_PACKET_SIZE, is_ts, read_ts_klv
 
-from io import BytesIO
 import xml.etree.ElementTree as ET
 from dateutil import parser as dup
 import logging
+import mmap
 import os
-from typing import List
+import tempfile
+from functools import partial
+from typing import BinaryIO, Callable, Dict, Generator, Iterable, Iterator, List, Set, Tuple, Union
+
+# Runs a generator to completion, handing each item to consume, and returns
+# the generator's return value
+def _drain(gen: Generator, consume: Callable = None):
+  while True:
+    try:
+      item = next(gen)
+    except StopIteration as stop:
+      return stop.value
+    if consume is not None:
+      consume(item)
+
+# While more data may still arrive, unregistered sets longer than this that
+# run past the end of the data are taken for corruption rather than waited
+# for, so a bad length can't hold the rest of a stream in the buffer
+MAX_UNKNOWN_SET = 2**16
+# Default for KLVParser's max_packet_wait
+MAX_PACKET_WAIT = 2**24
 
 class KLVParser(Parser):
   tel_type = 'klv'
+  # Universal key -> name of each registered KLV set. See register_set()
   keys = {bytes.fromhex("06 0E 2B 34 02 0B 01 01 0E 01 03 01 01 00 00 00") : "misb" ,
           bytes.fromhex("06 0E 2B 34 01 01 01 01 0F 00 00 00 00 00 00 00") : "old_misb",
           bytes.fromhex("06 0E 2B 34 02 05 01 01 0E 01 01 03 11 00 00 00") : "misb_comm_time"}
+  # SMPTE universal label prefix shared by every key above. Used to jump
+  # straight to the next candidate key when resynchronising on corrupt data
+  key_prefix = os.path.commonprefix(list(keys))
+  # Sets holding a UAS Datalink Local Set (MISB 0601). These are checksum
+  # verified and decoded with _parse_misb_packet
+  uas_sets = {"misb", "old_misb"}
+  # Set name -> parse(parser, buf, body_start, set_end) for every other
+  # registered set. It returns a Packet or None if the set is malformed
+  # Registered sets without a parser (e.g. misb_comm_time) are skipped
+  set_parsers = {}
 
+  # lazy: Store each element's raw value and only decode it the first time
+  #   it is accessed from the Packet
+  # tags: Only decode these MISB tags (tag numbers and/or element names).
+  #   Every other tag is skipped over by its length. Defaults to all tags
+  # verify_checksum: Check each packet against its Checksum (tag 1)
+  # checksum_policy: What to do with packets that fail verification
+  #   "drop": Count and skip them
+  #   "flag": Count them and keep them with Packet.checksum_failed set
+  # share_values: Decode fields that repeat in every packet (misb_shared, e.g.
+  #   Mission ID) to one Element shared by all packets with the same value
+  #   Shared Elements must be copied before being modified
+  # max_packet_wait: While streaming, registered sets other than UAS Local
+  #   Sets that run past the data read so far are only waited for if they're
+  #   at most this long. Longer ones are counted as dropped. UAS Local Sets
+  #   are waited for whatever their length unless it's found to be corrupt
   def __init__(self, source: str,
                is_embedded: bool = True,
-               use_misb_name: bool = True):
+               use_misb_name: bool = True,
+               lazy: bool = False,
+               tags: Iterable[Union[int, str]] = None,
+               verify_checksum: bool = False,
+               checksum_policy: str = "drop",
+               share_values: bool = True,
+               max_packet_wait: int = MAX_PACKET_WAIT):
+    if checksum_policy not in ["drop", "flag"]:
+      raise ValueError("checksum_policy must be 'drop' or 'flag', not '{}'".format(checksum_policy))
+
     self.source = source
+    self.is_embedded = is_embedded
     self.use_misb_name = use_misb_name
+    self.lazy = lazy
+    self.verify_checksum = verify_checksum
+    self.checksum_policy = checksum_policy
+    self.share_values = share_values
+    self.max_packet_wait = max_packet_wait
     self.logger = logging.getLogger("OTK.KLVParser")
     self.element_dict = {}
+    self.decoders = {}
     self._build_dict(MISB_0601)
+    self.tags = self._resolve_tags(tags) if tags is not None else None
+    # Corruption counters for the most recent read()/stream()
+    self.bytes_skipped = 0
+    self.packets_dropped = 0
+    self.checksum_failures = 0
+    self.sets_skipped = 0
+
+  # Registers the set with universal key key under name so the parser
+  # dispatches it to parse. Without a parse function sets with this key are
+  # skipped by their length. Registering on a subclass leaves the parent alone
+  @classmethod
+  def register_set(cls, key: bytes, name: str, parse: Callable = None):
+    if len(key) != 16:
+      raise ValueError("Universal keys are 16 bytes, not {}".format(len(key)))
+
+    cls.keys = dict(cls.keys)
+    cls.keys[key] = name
+    cls.set_parsers = dict(cls.set_parsers)
+    if parse is not None:
+      cls.set_parsers[name] = parse
+    else:
+      cls.set_parsers.pop(name, None)
+    cls.key_prefix = os.path.commonprefix(list(cls.keys))
 
   def _build_dict(self, cls):
     for subcls in cls.__subclasses__():
       if isinstance(subcls.misb_tag, int):
         self.element_dict[subcls.misb_tag] = subcls
+        key = subcls.misb_name if self.use_misb_name else subcls.name
+        decoder = subcls.decoder()
+        if self.share_values and subcls.misb_shared:
+          decoder = shared_decoder(decoder)
+        self.decoders[subcls.misb_tag] = (key, decoder)
 
       self._build_dict(subcls)
 
-  def read(self):
+  # Raw KLV files are memory mapped and MPEG-TS sources are demuxed natively
+  # Everything else goes through ffmpeg
+  def read(self) -> Telemetry:
+    if self._is_raw():
+      return self._parse(self._map_source())
+    if is_ts(self.source):
+      with open(self.source, "rb") as ts_stream:
+        return Telemetry(list(self._parse_ts(ts_stream, 2**20)))
+
+    return self._parse(self._read_extracted())
+
+  # Generator alternative to read() that parses the ffmpeg output as it arrives
+  # Only the unparsed tail of the stream is buffered so memory is bounded by
+  # the largest packet rather than the length of the recording
+  def stream(self, chunk_size: int = 2**16) -> Iterator[Packet]:
+    if self._is_raw():
+      yield from self._stream_buffer(self._map_source())
+      return
+    if is_ts(self.source):
+      with open(self.source, "rb") as ts_stream:
+        yield from self._parse_ts(ts_stream, chunk_size)
+      return
+    cache = get_cache()
+    key = cache.key(self.source) if cache is not None else None
+    path = cache.path(key, "klv") if key is not None else None
+    if path is not None:
+      yield from self._stream_buffer(self._map_source(path))
+      return
+
     metadata = read_video_metadata(self.source)
-    klv = read_klv(self.source, metadata)
-    self.klv_stream = BytesIO(klv)
-
-    return self._parse()
-    
-  def _parse(self):
-    stream_end = self.klv_stream.seek(0, os.SEEK_END)
-    self.klv_stream.seek(0, os.SEEK_SET)
-    packet_start = 0
-    key = self.klv_stream.read(16)
+    proc = open_klv_stream(self.source, metadata)
+    # On a cache miss the stream is copied into the cache as it's parsed. The
+    # entry is only kept if all of it was read
+    entry = cache.open_entry(key, "klv") if key is not None else None
+    complete = False
+    try:
+      yield from self._parse_stream(proc.stdout, chunk_size, entry)
+      complete = True
+    finally:
+      proc.stdout.close()
+      if proc.poll() is None:
+        proc.kill()
+      proc.wait()
+      if entry is not None:
+        if complete and proc.returncode == 0:
+          entry.commit()
+        else:
+          entry.abort()
+
+  # Follow mode for raw KLV and MPEG-TS files that are still being written.
+  # Each packet is returned once, by the poll its last byte arrived in
+  def poll(self) -> Telemetry:
+    if not self._is_raw() and not is_ts(self.source):
+      if os.path.getsize(self.source) < 3 * TS_PACKET_SIZE:
+        # Too little written to tell if it's MPEG-TS yet
+        return Telemetry()
+      raise ValueError("Follow mode needs a raw KLV or MPEG-TS file. {} is neither".format(self.source))
+
+    data = self._read_appended()
     tel = Telemetry()
-    while self.klv_stream.tell() != stream_end:
-      if key in self.keys:
-        if self.keys[key] in ["misb", "old_misb"]:
-          packet_len = self._read_len()
-          packet_end = self.klv_stream.tell() + packet_len
-          if not self._parse_misb_packet(tel, packet_end):
-            self.klv_stream.seek(packet_start + 1, os.SEEK_SET)
-        elif self.keys[key] in ["misb_comm_time"]:
-          self.logger.warn("Unsupported MISB key found. Skipping packet...")
-          packet_len = self._read_len()
-          self.klv_stream.seek(packet_len, os.SEEK_CUR)
+    if self._follow_demuxer is None:
+      units = [(None, data)]
+    else:
+      units = self._follow_demuxer.feed(data)
+
+    for pts, klv in units:
+      buf = self._follow_tail + klv
+      packets = self._parse_buffer(buf, 0, len(buf))
+      if self._follow_demuxer is not None:
+        packets = self._set_pts(packets, pts)
+      pos = _drain(packets, tel.append)
+      self._follow_tail = buf[pos:]
+
+    return tel
+
+  def _reset_follow(self):
+    super()._reset_follow()
+    self._follow_demuxer = None if self._is_raw() else TSDemuxer()
+    self._reset_counters()
+
+  # Raw KLV dumps (not embedded in a video) are parsed from the file directly
+  def _is_raw(self) -> bool:
+    _, _, ext = split_path(self.source)
+    return not self.is_embedded or ext in RAW_KLV_EXTENSIONS
+
+  # Maps the source read-only so the page cache is the only copy of it, and
+  # files larger than RAM are paged in and out as they're parsed
+  # The map isn't closed explicitly. Lazy packets and some decoded values keep
+  # views into it, and it's unmapped once the last of them is gone
+  def _map_source(self, path: str = None) -> bytes:
+    with open(path or self.source, "rb") as fl:
+      if os.fstat(fl.fileno()).st_size == 0:
+        return b""
+      data = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(data, "madvise"):
+      data.madvise(mmap.MADV_SEQUENTIAL)
+    return data
+
+  def _stream_buffer(self, data: bytes) -> Iterator[Packet]:
+    self._reset_counters()
+    pos = yield from self._parse_buffer(data, 0, len(data), final=True)
+    if pos != len(data):
+      self.logger.warn("Data ended in the middle of a packet. Discarding {} bytes".format(len(data) - pos))
+    self._log_counters()
+
+  # The KLV stream ffmpeg extracts from the source. If the cache is enabled
+  # ffmpeg writes it straight into the cache, so an unchanged video is only
+  # extracted once, and it's memory mapped from there
+  def _read_extracted(self) -> bytes:
+    cache = get_cache()
+    key = cache.key(self.source) if cache is not None else None
+    path = cache.path(key, "klv") if key is not None else None
+    if path is not None:
+      return self._map_source(path)
+
+    metadata = read_video_metadata(self.source)
+    if key is not None:
+      path = cache.store_file(key, "klv", partial(extract_klv, self.source, metadata))
+      if path is not None:
+        return self._map_source(path)
+    return read_klv(self.source, metadata)
+
+  # Parses the KLV stream written to a pipe by detector.open_telemetry_streams
+  def _read_pipe(self, pipe: BinaryIO) -> Telemetry:
+    return Telemetry(list(self._parse_stream(pipe, 2**16)))
+
+  # copy_to: Also writes everything read from klv_stream here
+  def _parse_stream(self, klv_stream: BinaryIO, chunk_size: int, copy_to: BinaryIO = None) -> Iterator[Packet]:
+    self._reset_counters()
+    # Kept as immutable bytes so decoded values may safely hold views into it
+    buf = b""
+    eof = False
+    while not eof:
+      chunk = klv_stream.read1(chunk_size)
+      if chunk:
+        if copy_to is not None:
+          copy_to.write(chunk)
+        buf += chunk
       else:
-        self.klv_stream.seek(-15, os.SEEK_CUR)
+        eof = True
+
+      pos = yield from self._parse_buffer(buf, 0, len(buf), final=eof)
+      buf = buf[pos:]
+
+    if len(buf) > 0:
+      self.logger.warn("Stream ended in the middle of a packet. Discarding {} bytes".format(len(buf)))
+    self._log_counters()
+
+  # Demuxes the KLV PES out of an MPEG-TS stream and parses them as they
+  # complete. Each Packet's pts is set from the PES that completed it
+  def _parse_ts(self, ts_stream: BinaryIO, chunk_size: int) -> Iterator[Packet]:
+    self._reset_counters()
+    demuxer = TSDemuxer()
+    buf = b""
+    pts = None
+    eof = False
+    while not eof:
+      chunk = ts_stream.read(chunk_size)
+      if chunk:
+        units = demuxer.feed(chunk)
+      else:
+        units = demuxer.flush()
+        eof = True
+
+      for pts, klv in units:
+        buf += klv
+        pos = yield from self._set_pts(self._parse_buffer(buf, 0, len(buf)), pts)
+        buf = buf[pos:]
 
-      packet_start = self.klv_stream.tell()
-      key = self.klv_stream.read(16)
+    if len(buf) > 0:
+      # Nothing more is coming so whatever is left can be resynced through
+      pos = yield from self._set_pts(self._parse_buffer(buf, 0, len(buf), final=True), pts)
+      buf = buf[pos:]
+
+    if len(buf) > 0:
+      self.logger.warn("Stream ended in the middle of a packet. Discarding {} bytes".format(len(buf)))
+    self.bytes_skipped += demuxer.bytes_skipped
+    self._log_counters()
+
+  def _set_pts(self, packets: Generator[Packet, None, int], pts: int) -> Generator[Packet, None, int]:
+    while True:
+      try:
+        packet = next(packets)
+      except StopIteration as stop:
+        return stop.value
+      packet.pts = pts
+      yield packet
+
+  def _parse(self, klv: bytes) -> Telemetry:
+    self._reset_counters()
+    tel = Telemetry()
+    pos = _drain(self._parse_buffer(klv, 0, len(klv), final=True), tel.append)
+
+    if pos != len(klv):
+      self.logger.warn("Data ended in the middle of a packet. Discarding {} bytes".format(len(klv) - pos))
+    self._log_counters()
 
     return tel
 
-  def _parse_misb_packet(self, tel, packet_end):
-    packet = Packet()
+  # Columnar alternative to read() for numeric tags. Rather than building a
+  # Packet per packet, raw values are gathered per tag and decoded with NumPy
+  # in one pass per tag. Requires numpy
+  # tags: MISB tag numbers and/or element names to keep. Defaults to the
+  #   parser's tags, or if it has none every numeric tag found in the data
+  def read_columns(self, tags: Iterable[Union[int, str]] = None) -> 'KLVColumns':
+    return self._parse_columns(self._read_source(), tags)
 
-    first_packet = True
-    while self.klv_stream.tell() != packet_end:
-      tag = self._read_tag()
+  def _parse_columns(self, klv: bytes, tags: Iterable[Union[int, str]] = None) -> 'KLVColumns':
+    from .klv_columns import KLVColumnCollector, is_numeric
 
-      if first_packet and tag != TimestampElement.misb_tag:
-        # Per MISB 0601 standard, first tag must be timestamp
-        self.logger.warn("First element in packet was not Timestamp. Skipping Packet...")
-        break
-      first_packet = False
+    if tags is None:
+      tags = self.tags
+    columns = {}
+    if tags is None:
+      for tag, cls in self.element_dict.items():
+        if is_numeric(cls):
+          columns[tag] = self.decoders[tag][0], cls
+    else:
+      for tag in self._resolve_tags(tags):
+        if is_numeric(self.element_dict[tag]):
+          columns[tag] = self.decoders[tag][0], self.element_dict[tag]
+        else:
+          self.logger.warn("Tag {} is not numeric. Leaving it out of the columns".format(tag))
+
+    # Unless specific tags were asked for only keep columns that show up
+    collector = KLVColumnCollector(columns, drop_missing=tags is None)
+    def collect_packet(buf, pos, packet_end):
+      fields = self._split_misb_packet(buf, pos, packet_end, columns)
+      if fields is None:
+        return None
+      collector.add(buf, fields)
+      return True
 
-      elem_len = self._read_len()
-      if self.klv_stream.tell() + elem_len > packet_end:
-        self.logger.warn("Have parsed more bytes than expected. Skipping Packet...")
-        break
+    self._reset_counters()
+    pos = _drain(self._parse_buffer(klv, 0, len(klv), collect_packet, final=True))
+    if pos != len(klv):
+      self.logger.warn("Data ended in the middle of a packet. Discarding {} bytes".format(len(klv) - pos))
+    self._log_counters()
 
-      value = self.klv_stream.read(elem_len)
+    return collector.finish()
 
+  # Builds a time index over the source with one light pass that only reads
+  # each packet's position and Precision Time Stamp. Packets in a time window
+  # can then be decoded on their own with seek_time()/range()
+  def build_index(self) -> 'KLVIndex':
+    from .klv_index import KLVIndex
+
+    data = self._read_source()
+    cache = get_cache()
+    # Only checksum handling changes which packets are indexed
+    key = cache.key(self.source, "index", self.verify_checksum, self.checksum_policy) \
+          if cache is not None else None
+    if key is not None:
+      raw = cache.load(key, "idx")
+      if raw is not None:
+        return KLVIndex.from_bytes(self, data, raw)
+
+    index = KLVIndex.build(self, data)
+    if key is not None:
+      cache.store(key, "idx", index.to_bytes())
+    return index
+
+  # The source's whole KLV stream as a single buffer
+  def _read_source(self) -> bytes:
+    if self._is_raw():
+      return self._map_source()
+    if is_ts(self.source):
+      with open(self.source, "rb") as ts_stream:
+        return b"".join(klv for _, klv in read_ts_klv(ts_stream))
+
+    return self._read_extracted()
+
+  # Maps MISB tag numbers and element names (either name or misb_name) to tag numbers
+  def _resolve_tags(self, tags: Iterable[Union[int, str]]) -> Set[int]:
+    names = {}
+    for tag, cls in self.element_dict.items():
+      names[cls.name] = tag
+      names[cls.misb_name] = tag
+
+    resolved = set()
+    for tag in tags:
       if tag in self.element_dict:
-        if self.use_misb_name:
-          packet[self.element_dict[tag].misb_name] = self.element_dict[tag].fromMISB(value)
-        else:
-          packet[self.element_dict[tag].name] = self.element_dict[tag].fromMISB(value)
-      else: 
-        self.logger.warn("Parsed an unrecognized tag. Creating an UnknownElement")
-        packet["Tag " + str(tag)] = UnknownElement(value)
+        resolved.add(tag)
+      elif tag in names:
+        resolved.add(names[tag])
+      else:
+        self.logger.warn("Unrecognized tag '{}'. Ignoring it".format(tag))
+
+    return resolved
+
+  # Multi-process alternative to read() for large recordings. The KLV stream
+  # is extracted to a temporary file that worker processes memory map and
+  # parse in chunks split at packet boundaries
+  # workers: Number of processes. Defaults to the number of CPUs
+  def read_parallel(self, workers: int = None) -> Telemetry:
+    from .klv_parallel import parse_file_parallel
+
+    if self._is_raw():
+      return parse_file_parallel(self, self.source, workers)
+
+    cache = get_cache()
+    if cache is not None:
+      # Workers can map the cached stream directly
+      self._read_extracted()
+      key = cache.key(self.source)
+      path = cache.path(key, "klv") if key is not None else None
+      if path is not None:
+        return parse_file_parallel(self, path, workers)
+
+    metadata = read_video_metadata(self.source)
+    with tempfile.TemporaryDirectory() as tmp:
+      klv_path = os.path.join(tmp, "klv.bin")
+      extract_klv(self.source, metadata, klv_path)
+      return parse_file_parallel(self, klv_path, workers)
+
+  # Returns the offset of the first packet at or after pos whose key and
+  # length check out, or end if there isn't one. A packet only counts if it
+  # runs exactly up to the next key (or end) so that a key-like run of bytes
+  # inside a value isn't mistaken for a packet
+  def _next_packet_start(self, data: bytes, pos: int, end: int) -> int:
+    keys = self.keys
+    while True:
+      pos = data.find(self.key_prefix, pos, end)
+      if pos < 0 or end - pos < 17:
+        return end
+
+      if data[pos : pos+16] in keys:
+        length = data[pos+16]
+        body_start = pos + 17
+        if length >= 128:
+          body_start += length - 128
+          length = int.from_bytes(data[pos+17 : body_start], "big")
+        packet_end = body_start + length
+        if packet_end == end or data[packet_end : packet_end+16] in keys:
+          return pos
+
+      pos += 1
+
+  def _reset_counters(self):
+    self.bytes_skipped = 0
+    self.packets_dropped = 0
+    self.checksum_failures = 0
+    self.sets_skipped = 0
 
-    if self.klv_stream.tell() == packet_end:
-      tel.append(packet)
+  def _log_counters(self):
+    if self.bytes_skipped or self.packets_dropped:
+      self.logger.warn("Skipped {} bytes of unrecognized data and dropped {} malformed packets"
+                       .format(self.bytes_skipped, self.packets_dropped))
+    if self.checksum_failures:
+      self.logger.warn("{} packets failed checksum verification".format(self.checksum_failures))
+    if self.sets_skipped:
+      self.logger.info("Skipped {} KLV sets without a parser".format(self.sets_skipped))
+
+  # True if the packet in buf[packet_start:packet_end] ends with a Checksum
+  # (tag 1, length 2) matching the sum of everything before its value
+  def _checksum_ok(self, buf: memoryview, packet_start: int, packet_end: int) -> bool:
+    if packet_end - packet_start < 21 or buf[packet_end-4] != 1 or buf[packet_end-3] != 2:
+      return False
+    return misb_checksum(buf, packet_start, packet_end - 2) == \
+           (buf[packet_end-2] << 8) + buf[packet_end-1]
+
+  # Universal key -> (parser, whether it's a UAS set) for one _parse_buffer
+  # call. parse_packet stands in for the UAS set parser, in which case other
+  # sets are skipped since they can't produce what it does
+  def _dispatch(self, parse_packet: Callable = None) -> Dict[bytes, Tuple[Callable, bool]]:
+    dispatch = {}
+    for key, name in self.keys.items():
+      if name in self.uas_sets:
+        dispatch[key] = (parse_packet or self._parse_misb_packet, True)
+      elif name in self.set_parsers and parse_packet is None:
+        dispatch[key] = (partial(self.set_parsers[name], self), False)
+      else:
+        dispatch[key] = (None, False)
+    return dispatch
+
+  # Jumps to the next possible key in one search rather than stepping byte by
+  # byte. If there isn't one only enough of the tail is kept to hold a key
+  # prefix split across reads
+  def _resync(self, data: bytes, pos: int, end: int) -> int:
+    resync = data.find(self.key_prefix, pos + 1, end)
+    if resync < 0:
+      resync = max(pos + 1, end - len(self.key_prefix) + 1)
+    self.bytes_skipped += resync - pos
+    return resync
+
+  # Whether a set that runs past the data read so far could still be valid
+  # and should be waited for. A UAS Local Set has to start with its
+  # timestamp, and if its checksum followed by a key shows up inside what
+  # should be its body then the packet really ended there and its length
+  # is corrupt. Other sets are waited for up to max_packet_wait bytes
+  def _worth_waiting(self, data: bytes, body_start: int, end: int, length: int, is_uas: bool) -> bool:
+    if not is_uas:
+      return length <= self.max_packet_wait
+    if end - body_start < 2:
       return True
-    else:
-      self.logger.warn("Have not parsed the expected number of bytes. Skipping Packet...")
+    if data[body_start] != TimestampElement.misb_tag or data[body_start+1] != 8:
       return False
 
-  def _read_len(self):
-    length = bytes_to_int(self.klv_stream.read(1))
+    key = data.find(SMPTE_UL_PREFIX, body_start + 4, end)
+    while key >= 0:
+      if data[key-4] == 1 and data[key-3] == 2:
+        return False
+      key = data.find(SMPTE_UL_PREFIX, key + 1, end)
+    return True
+
+  # Parses every complete packet in data[pos:end] and returns the offset at
+  # which parsing stopped (the start of an incomplete trailing packet, if any)
+  # parse_packet defaults to building a Packet but can be swapped for any
+  # callable taking (buf, body_start, packet_end) that returns None on failure
+  # final: No more data will follow, so a set running past end is corrupt and
+  #   is resynced past rather than waited for
+  # Sets are dispatched on their universal key with a single dict lookup
+  def _parse_buffer(self, data: bytes, pos: int, end: int,
+                    parse_packet: Callable = None,
+                    final: bool = False) -> Generator[Packet, None, int]:
+    dispatch = self._dispatch(parse_packet)
+    buf = memoryview(data)
+    while end - pos >= 17:
+      key = data[pos : pos+16]
+      entry = dispatch.get(key)
+      # Anything other than a set key with at most a 4 byte length is taken
+      # for corrupt data
+      if entry is None and (key[:5] != SMPTE_GROUP_PREFIX or buf[pos+16] > 0x84):
+        pos = self._resync(data, pos, end)
+        continue
+
+      length = buf[pos+16]
+      body_start = pos + 17
+      if length >= 128:
+        body_start += length - 128
+        if body_start > end:
+          if not final:
+            break
+          pos = self._resync(data, pos, end)
+          continue
+        length = int.from_bytes(buf[pos+17 : body_start], "big")
+      packet_end = body_start + length
+
+      if entry is None:
+        # Unregistered set. Step over it in one go if its length lands on the
+        # next key (or the end), otherwise it's corrupt data that happens to
+        # look like a key
+        if not final and end < packet_end + 4 and packet_end != end and length <= MAX_UNKNOWN_SET:
+          # Wait for enough data to check what follows it
+          break
+        elif packet_end == end or data[packet_end : packet_end+4] == SMPTE_UL_PREFIX:
+          self.sets_skipped += 1
+          pos = packet_end
+        else:
+          pos = self._resync(data, pos, end)
+        continue
+
+      parse, is_uas = entry
+      if packet_end > end:
+        if not final and self._worth_waiting(data, body_start, end, length, is_uas):
+          # Wait for the rest of the packet
+          break
+        # The length is corrupt. Search for the next key from just past this one
+        self.packets_dropped += 1
+        pos = self._resync(data, pos, end)
+        continue
+
+      if parse is None:
+        self.sets_skipped += 1
+        pos = packet_end
+        continue
+
+      checksum_failed = False
+      if is_uas and self.verify_checksum and not self._checksum_ok(buf, pos, packet_end):
+        self.checksum_failures += 1
+        if self.checksum_policy == "drop":
+          pos = packet_end
+          continue
+        checksum_failed = True
+
+      packet = parse(buf, body_start, packet_end)
+      if packet is None:
+        # Search for the next key from just past this one
+        self.packets_dropped += 1
+        self.bytes_skipped += 1
+        pos += 1
+        continue
+      if checksum_failed and isinstance(packet, Packet):
+        packet.checksum_failed = True
+      yield packet
+      pos = packet_end
 
-    if length >= 128:
-      length = bytes_to_int(self.klv_stream.read(length - 128))
+    return pos
 
-    return length
+  # Tags and lengths are decoded by offset and values are handed to fromMISB
+  # as slices of buf, so nothing is copied until an element decodes it
+  def _parse_misb_packet(self, buf: memoryview, pos: int, packet_end: int) -> Packet:
+    fields = self._split_misb_packet(buf, pos, packet_end, self.tags)
+    if fields is None:
+      return None
+
+    if self.lazy:
+      return LazyPacket(buf, fields, self.decoders)
+
+    packet = Packet()
+    # Fill the underlying dict directly to skip UserDict.__setitem__
+    elements = packet.data
+    decoders = self.decoders
+    for tag, value_start, value_end in fields:
+      if tag in decoders:
+        key, decode = decoders[tag]
+        elements[key] = decode(buf[value_start : value_end])
+      else: 
+        self.logger.warn("Parsed an unrecognized tag. Creating an UnknownElement")
+        elements["Tag " + str(tag)] = UnknownElement(bytes(buf[value_start : value_end]))
 
-  def _read_tag(self):
-    tag_byte = bytes_to_int(self.klv_stream.read(1))
+    return packet
 
-    if tag_byte < 128:
-      return tag_byte
+  # keep: Only return fields for these tags. None returns them all
+  def _split_misb_packet(self, buf: memoryview, pos: int, packet_end: int,
+                         keep: Set[int] = None) -> List[Tuple[int, int, int]]:
+    # Per MISB 0601 standard, first tag must be timestamp. It's a single byte
+    # tag so the first byte can be checked before the timestamp is filtered out
+    if pos >= packet_end or buf[pos] != TimestampElement.misb_tag:
+      self.logger.warn("First element in packet was not Timestamp. Skipping Packet...")
+      return None
 
-    tag = 0
-    while tag_byte >= 128:
-      tag = (tag << 7) + (tag_byte - 128)
-      tag_byte = bytes_to_int(self.klv_stream.read(1))
+    fields = split_local_set(buf, pos, packet_end, keep)
+    if fields is None:
+      self.logger.warn("Packet length does not match its contents. Skipping Packet...")
+      return None
 
-    tag = (tag << 7) + (tag_byte)
-    return tag
-    
\ No newline at end of file
+    return fields
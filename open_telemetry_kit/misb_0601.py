@@ -1,14 +1,65 @@
 #!/usr/bin/env python3
 
-from .klv_common import bytes_to_int, bytes_to_float, bytes_to_str
+from .klv_common import bytes_to_int, bytes_to_float, bytes_to_str, LocalSetView
 import logging
 from abc import ABCMeta
 from abc import abstractmethod
 from datetime import datetime
 from dateutil import parser as dup
-from typing import Tuple
+import struct
+from typing import Any, Callable, Tuple
+
+# struct formats for the fixed widths that have one. Keyed by (width, signed)
+_int_formats = {(1, False) : ">B", (1, True) : ">b",
+                (2, False) : ">H", (2, True) : ">h",
+                (4, False) : ">I", (4, True) : ">i",
+                (8, False) : ">Q", (8, True) : ">q"}
+
+# Returns a function that converts a big endian value of a known width to
+# an int with struct, falling back to int.from_bytes for any other length
+def _int_unpacker(width: int, signed: bool) -> Callable[[bytes], int]:
+  from_bytes = int.from_bytes
+  if (width, signed) not in _int_formats:
+    return lambda value: from_bytes(value, "big", signed=signed)
+
+  unpack = struct.Struct(_int_formats[(width, signed)]).unpack
+  def unpacker(value):
+    if len(value) == width:
+      return unpack(value)[0]
+    return from_bytes(value, "big", signed=signed)
+  return unpacker
+
+# Inverse of _int_unpacker. Converts an int to big endian bytes of a known width
+def _int_packer(width: int, signed: bool) -> Callable[[int], bytes]:
+  if (width, signed) not in _int_formats:
+    return lambda value: value.to_bytes(width, "big", signed=signed)
+  return struct.Struct(_int_formats[(width, signed)]).pack
+
+# IMAPB lengths aren't recorded on the element classes so this many bytes
+# are used when encoding them
+_IMAPB_WIDTH = 4
+
+# Wraps decode so every value with the same raw bytes decodes to the same
+# shared Element. Once max_entries distinct values have been seen new ones
+# are decoded as usual, so a field that does change doesn't grow the cache
+def shared_decoder(decode: Callable[[bytes], Any], max_entries: int = 256) -> Callable[[bytes], Any]:
+  cache = {}
+  def shared(value):
+    key = bytes(value)
+    element = cache.get(key)
+    if element is None:
+      element = decode(value)
+      if len(cache) < max_entries:
+        cache[key] = element
+    return element
+  return shared
 
 class MISB_0601(metaclass=ABCMeta):
+  # Elements that usually hold the same value in every packet (mission ID,
+  # platform designation, ...). KLVParser shares one decoded Element between
+  # all packets with the same raw value, so these must not be modified in place
+  misb_shared = False
+
   @classmethod
   @abstractmethod
   def fromMISB(cls, value):
@@ -38,16 +89,57 @@ class MISB_0601(metaclass=ABCMeta):
   def misb_units(cls) -> str:
     pass
 
-class MISB_int(MISB_0601):
-  @property
+  # Returns a single callable equivalent to fromMISB with everything that
+  # only depends on the class worked out ahead of time. Used by KLVParser to
+  # build its tag -> decoder table. Subclasses with their own fromMISB
+  # simply get fromMISB back
+  @classmethod
+  def decoder(cls) -> Callable[[bytes], Any]:
+    return cls.fromMISB
+
+  # Returns a callable that encodes an element of this class back to the
+  # bytes of its MISB value (the inverse of decoder) or None if encoding this
+  # element isn't supported. Used by KLVEncoder
   @classmethod
-  def _signed(cls) -> bool:
-    False
+  def encoder(cls) -> Callable[[Any], bytes]:
+    return None
+
+class MISB_int(MISB_0601):
+  _signed = False
+  # Number of bytes a value is encoded in. None for tags the standard gives a
+  # variable length
+  _width = None
 
   @classmethod
   def fromMISB(cls, value):
     return cls(bytes_to_int(value, cls._signed))
 
+  @classmethod
+  def decoder(cls) -> Callable[[bytes], Any]:
+    if cls.fromMISB.__func__ is not MISB_int.fromMISB.__func__:
+      return cls.fromMISB
+
+    signed = cls._signed
+    from_bytes = int.from_bytes
+    return lambda value: cls(from_bytes(value, "big", signed=signed))
+
+  # Values are encoded in _width bytes, or as few as they can be for tags with
+  # a variable length
+  @classmethod
+  def encoder(cls) -> Callable[[Any], bytes]:
+    if cls.fromMISB.__func__ is not MISB_int.fromMISB.__func__:
+      return None
+
+    signed = cls._signed is True
+    if cls._width is not None:
+      pack = _int_packer(cls._width, signed)
+      return lambda element: pack(int(element.value))
+
+    def encode(element):
+      value = int(element.value)
+      return value.to_bytes((value.bit_length() + signed + 7) // 8 or 1, "big", signed=signed)
+    return encode
+
 class MISB_float(MISB_0601):
   @property
   @classmethod
@@ -69,7 +161,8 @@ class MISB_float(MISB_0601):
   @classmethod
   def fromMISB(cls, value):
     if isinstance(cls._invalid, bytes) and value == cls._invalid:
-      c = cls(0).value = None
+      c = cls(0)
+      c.value = None
       return c
     elif cls._domain == 'IMAPB':
       l = len(value)
@@ -77,7 +170,115 @@ class MISB_float(MISB_0601):
     else:
       return cls(bytes_to_float(value, cls._domain, cls._range))
 
+  # Number of bytes a value is encoded in. None for IMAPB where it varies
+  @classmethod
+  def _width(cls) -> int:
+    if cls._domain == 'IMAPB':
+      return None
+    x0, x1 = cls._domain
+    return (max(abs(x0), abs(x1)).bit_length() + (x0 < 0) + 7) // 8
+
+  # Constants that map a raw integer of the given length onto _range as
+  # raw * scale + offset. Returns (scale, offset, signed)
+  @classmethod
+  def _linear_map(cls, length: int) -> Tuple[float, float, bool]:
+    y0, y1 = cls._range
+    if cls._domain == 'IMAPB':
+      x0, x1 = 0, 2**(8*length) - 1
+    else:
+      x0, x1 = cls._domain
+    scale = (y1 - y0) / (x1 - x0)
+    return (scale, y0 - x0 * scale, x0 < 0)
+
+  @classmethod
+  def decoder(cls) -> Callable[[bytes], Any]:
+    if cls.fromMISB.__func__ is not MISB_float.fromMISB.__func__:
+      return cls.fromMISB
+
+    invalid = cls._invalid if isinstance(cls._invalid, bytes) else None
+
+    def invalid_element():
+      c = cls(0)
+      c.value = None
+      return c
+
+    if cls._domain == 'IMAPB':
+      # The domain depends on the length so the mapping is computed per length
+      from_bytes = int.from_bytes
+      maps = {}
+      def decode(value):
+        if value == invalid:
+          return invalid_element()
+        l = len(value)
+        if l not in maps:
+          maps[l] = cls._linear_map(l)
+        scale, offset, _ = maps[l]
+        return cls(from_bytes(value, "big") * scale + offset)
+      return decode
+
+    width = cls._width()
+    scale, offset, signed = cls._linear_map(width)
+    unpack = _int_unpacker(width, signed)
+    if invalid is None:
+      return lambda value: cls(unpack(value) * scale + offset)
+
+    def decode(value):
+      if value == invalid:
+        return invalid_element()
+      return cls(unpack(value) * scale + offset)
+    return decode
+
+  @classmethod
+  def encoder(cls) -> Callable[[Any], bytes]:
+    if cls.fromMISB.__func__ is not MISB_float.fromMISB.__func__:
+      return None
+
+    invalid = cls._invalid if isinstance(cls._invalid, bytes) else None
+    if cls._domain == 'IMAPB':
+      width = _IMAPB_WIDTH
+      x0, x1 = 0, 2**(8*width) - 1
+    else:
+      width = cls._width()
+      x0, x1 = cls._domain
+    scale, offset, signed = cls._linear_map(width)
+    pack = _int_packer(width, signed)
+
+    def encode(element):
+      if element.value is None:
+        if invalid is None:
+          raise ValueError("{} has no invalid value to encode None as".format(cls.__name__))
+        return invalid
+      raw = round((float(element.value) - offset) / scale)
+      return pack(min(max(raw, x0), x1))
+    return encode
+
 class MISB_str(MISB_0601):
   @classmethod
   def fromMISB(cls, value):
     return cls(bytes_to_str(value))
+
+  @classmethod
+  def decoder(cls) -> Callable[[bytes], Any]:
+    if cls.fromMISB.__func__ is not MISB_str.fromMISB.__func__:
+      return cls.fromMISB
+
+    return lambda value: cls(str(value, "utf-8"))
+
+  @classmethod
+  def encoder(cls) -> Callable[[Any], bytes]:
+    if cls.fromMISB.__func__ is not MISB_str.fromMISB.__func__:
+      return None
+
+    return lambda element: str(element.value).encode("utf-8")
+
+# Elements whose value is a local set from another standard (e.g. Security,
+# VMTI). The value is a LocalSetView over the parent packet so nothing in the
+# set is parsed or copied unless it's read
+class MISB_LocalSet(MISB_0601):
+  @classmethod
+  def fromMISB(cls, value):
+    return cls(LocalSetView(value))
+
+  @classmethod
+  def encoder(cls) -> Callable[[Any], bytes]:
+    return lambda element: bytes(element.value)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# Minimal MPEG-TS demuxer that pulls KLV metadata out of a transport stream
+# (e.g. STANAG 4609) without going through ffmpeg
+# PAT -> PMT -> KLV PIDs -> PES reassembly -> KLV bytes and their PTS
+
+import logging
+from typing import BinaryIO, Iterator, List, Tuple
+
+logger = logging.getLogger("OTK.mpegts")
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PAT_PID = 0
+
+# Stream types KLV is carried in. 0x15 is metadata carried in PES (wrapped in
+# metadata access unit cells), 0x06 is private data (raw KLV, e.g. async
+# KLV per MISB ST 1402)
+METADATA_STREAM_TYPE = 0x15
+PRIVATE_STREAM_TYPE = 0x06
+
+# PES stream_ids that have no optional PES header
+_NO_PES_HEADER = {0xBC, 0xBE, 0xBF, 0xF0, 0xF1, 0xF2, 0xF8, 0xFF}
+
+# True if the file starts with a run of TS sync bytes
+def is_ts(path: str) -> bool:
+  try:
+    with open(path, "rb") as fl:
+      head = fl.read(3 * TS_PACKET_SIZE)
+  except OSError:
+    return False
+
+  return len(head) == 3 * TS_PACKET_SIZE and \
+         all(head[idx * TS_PACKET_SIZE] == SYNC_BYTE for idx in range(3))
+
+def _read_pts(data: bytes, pos: int) -> int:
+  return (((data[pos] >> 1) & 0x07) << 30) | (data[pos+1] << 22) | \
+         ((data[pos+2] >> 1) << 15) | (data[pos+3] << 7) | (data[pos+4] >> 1)
+
+def _is_klv_stream(stream_type: int, descriptors: bytes) -> bool:
+  # Both the registration (0x05) and metadata (0x26) descriptors carry the
+  # 'KLVA' format identifier
+  pos = 0
+  while pos + 2 <= len(descriptors):
+    tag = descriptors[pos]
+    length = descriptors[pos+1]
+    body = descriptors[pos+2 : pos+2+length]
+    if tag in (0x05, 0x26) and b"KLVA" in body:
+      return True
+    pos += 2 + length
+
+  # Some muxers leave the descriptor off metadata streams
+  return stream_type == METADATA_STREAM_TYPE
+
+# Strips the 5 byte metadata AU cell headers from a stream type 0x15 payload
+def _strip_au_cells(payload: bytes) -> bytes:
+  out = []
+  pos = 0
+  while pos + 5 <= len(payload):
+    length = (payload[pos+3] << 8) | payload[pos+4]
+    out.append(payload[pos+5 : pos+5+length])
+    pos += 5 + length
+  return b"".join(out)
+
+# Incremental demuxer. feed() takes arbitrary chunks of the transport stream
+# and returns the KLV payload of each PES completed by them as (pts, klv).
+# pts is in 90 kHz ticks or None if the PES didn't carry one
+class TSDemuxer:
+  def __init__(self):
+    self.klv_pids = {}    # PID -> stream type
+    self.pmt_pids = set()
+    self._sections = {}   # PID -> partial PSI section
+    self._pes = {}        # PID -> partial PES
+    self._tail = b""
+    self._synced = False
+    self.bytes_skipped = 0
+
+  def feed(self, data: bytes) -> List[Tuple[int, bytes]]:
+    if self._tail:
+      data = self._tail + data
+    out = []
+    pos = 0
+    end = len(data)
+    while end - pos >= TS_PACKET_SIZE:
+      if not self._synced or data[pos] != SYNC_BYTE:
+        # Only (re)lock on to a sync byte that's followed by another one so
+        # a stray 0x47 in garbage isn't taken for a packet
+        self._synced = False
+        resync = pos if data[pos] == SYNC_BYTE else data.find(SYNC_BYTE, pos + 1)
+        while 0 <= resync and resync + TS_PACKET_SIZE < end and \
+              data[resync + TS_PACKET_SIZE] != SYNC_BYTE:
+          resync = data.find(SYNC_BYTE, resync + 1)
+        if resync < 0:
+          resync = end
+        self.bytes_skipped += resync - pos
+        pos = resync
+        if end - pos <= TS_PACKET_SIZE:
+          # Wait for enough data to confirm it
+          break
+        self._synced = True
+
+      self._packet(data, pos, out)
+      pos += TS_PACKET_SIZE
+
+    self._tail = data[pos:]
+    return out
+
+  # Emits any PES still being assembled at the end of the stream
+  def flush(self) -> List[Tuple[int, bytes]]:
+    out = []
+    for pid in list(self._pes):
+      self._finish_pes(pid, out)
+    return out
+
+  def _packet(self, data: bytes, pos: int, out: List[Tuple[int, bytes]]):
+    pid = ((data[pos+1] & 0x1F) << 8) | data[pos+2]
+    if pid != PAT_PID and pid not in self.pmt_pids and pid not in self.klv_pids:
+      return
+
+    unit_start = data[pos+1] & 0x40
+    adaptation = (data[pos+3] >> 4) & 0x03
+    payload_start = pos + 4
+    if adaptation & 0x02:
+      payload_start += 1 + data[pos+4]
+    if not adaptation & 0x01 or payload_start >= pos + TS_PACKET_SIZE:
+      return
+    payload = data[payload_start : pos + TS_PACKET_SIZE]
+
+    if pid in self.klv_pids:
+      if unit_start:
+        self._finish_pes(pid, out)
+        self._pes[pid] = bytearray(payload)
+      elif pid in self._pes:
+        self._pes[pid] += payload
+      else:
+        return
+      self._check_pes_length(pid, out)
+    else:
+      self._section(pid, unit_start, payload)
+
+  def _section(self, pid: int, unit_start: int, payload: bytes):
+    if unit_start:
+      # Skip the pointer field
+      self._sections[pid] = bytearray(payload[1 + payload[0]:])
+    elif pid in self._sections:
+      self._sections[pid] += payload
+    else:
+      return
+
+    section = self._sections[pid]
+    if len(section) < 3:
+      return
+    section_end = 3 + (((section[1] & 0x0F) << 8) | section[2])
+    if len(section) < section_end:
+      return
+    del self._sections[pid]
+
+    # Skip the 5 bytes of the long header after the length. Leave off the CRC
+    body = bytes(section[8 : section_end - 4])
+    if pid == PAT_PID and section[0] == 0x00:
+      self._pat(body)
+    elif section[0] == 0x02:
+      self._pmt(body)
+
+  def _pat(self, body: bytes):
+    for pos in range(0, len(body) - 3, 4):
+      program = (body[pos] << 8) | body[pos+1]
+      if program != 0:
+        self.pmt_pids.add(((body[pos+2] & 0x1F) << 8) | body[pos+3])
+
+  def _pmt(self, body: bytes):
+    pos = 4 + (((body[2] & 0x0F) << 8) | body[3])
+    while pos + 5 <= len(body):
+      stream_type = body[pos]
+      pid = ((body[pos+1] & 0x1F) << 8) | body[pos+2]
+      info_len = ((body[pos+3] & 0x0F) << 8) | body[pos+4]
+      descriptors = body[pos+5 : pos+5+info_len]
+      if stream_type in (METADATA_STREAM_TYPE, PRIVATE_STREAM_TYPE) and \
+         _is_klv_stream(stream_type, descriptors):
+        if pid not in self.klv_pids:
+          logger.info("Found KLV stream on PID {}".format(pid))
+        self.klv_pids[pid] = stream_type
+      pos += 5 + info_len
+
+  # PES with a length can be emitted as soon as they're complete rather
+  # than waiting for the start of the next one
+  def _check_pes_length(self, pid: int, out: List[Tuple[int, bytes]]):
+    pes = self._pes[pid]
+    if len(pes) >= 6:
+      length = (pes[4] << 8) | pes[5]
+      if length and len(pes) >= 6 + length:
+        self._finish_pes(pid, out)
+
+  def _finish_pes(self, pid: int, out: List[Tuple[int, bytes]]):
+    pes = self._pes.pop(pid, None)
+    if pes is None or len(pes) < 6 or pes[0:3] != b"\x00\x00\x01":
+      return
+
+    length = (pes[4] << 8) | pes[5]
+    end = 6 + length if length else len(pes)
+    pts = None
+    if pes[3] in _NO_PES_HEADER:
+      payload_start = 6
+    else:
+      if len(pes) < 9:
+        return
+      if pes[7] & 0x80:
+        pts = _read_pts(pes, 9)
+      payload_start = 9 + pes[8]
+
+    payload = bytes(pes[payload_start : end])
+    if self.klv_pids[pid] == METADATA_STREAM_TYPE:
+      payload = _strip_au_cells(payload)
+    out.append((pts, payload))
+
+# Yields (pts, klv) for every KLV PES in a transport stream
+def read_ts_klv(ts_stream: BinaryIO, chunk_size: int = 2**20) -> Iterator[Tuple[int, bytes]]:
+  demuxer = TSDemuxer()
+  while True:
+    chunk = ts_stream.read(chunk_size)
+    if not chunk:
+      break
+    yield from demuxer.feed(chunk)
+  yield from demuxer.flush()
@@ -1,13 +1,88 @@
 #!/usr/bin/env python3
 
 from collections import UserDict
-from typing import Dict
+from typing import Any, Callable, Dict, List, Tuple
 
-from .element import Element
+from .element import Element, UnknownElement
 
 class Packet(UserDict):
+  # Set by KLVParser when checksum verification flags a packet instead of dropping it
+  checksum_failed = False
+  # Set by KLVParser to the PTS (90 kHz ticks) of the MPEG-TS PES a packet came from
+  pts = None
+
   def __init__(self, elements: Dict[str, Element] = {}):
     UserDict.__init__(self, elements)
 
   def toJson(self) -> Dict[str, Element]:
+    return self.data
+
+# Placeholder for an element whose raw value has not been decoded yet
+class LazyElement:
+  __slots__ = ("decode", "raw")
+
+  def __init__(self, decode: Callable[[Any], Element], raw: Any):
+    self.decode = decode
+    self.raw = raw
+
+  def resolve(self) -> Element:
+    return self.decode(self.raw)
+
+  def toJson(self) -> Any:
+    return self.resolve().toJson()
+
+# Packet whose elements are decoded on demand. Nothing is done with the raw
+# packet until the Packet is first used. At that point each element gets a
+# LazyElement placeholder, which is decoded the first time it is looked up
+# and replaced by the decoded Element so it's only ever decoded once
+class LazyPacket(Packet):
+  # buf: Buffer holding the packet
+  # fields: (tag, value_start, value_end) for each element in buf
+  # decoders: tag -> (key, decoder) used to name and decode each element
+  def __init__(self, buf: memoryview = None,
+               fields: List[Tuple[int, int, int]] = None,
+               decoders: Dict[int, Tuple[str, Callable[[Any], Element]]] = None):
+    self._pending = None
+    Packet.__init__(self)
+    if fields:
+      self._pending = (buf, fields, decoders)
+
+  @property
+  def data(self) -> Dict[str, Element]:
+    if self._pending is not None:
+      buf, fields, decoders = self._pending
+      self._pending = None
+      data = self._data
+      for tag, value_start, value_end in fields:
+        if tag in decoders:
+          key, decode = decoders[tag]
+          data[key] = LazyElement(decode, buf[value_start : value_end])
+        else:
+          data["Tag " + str(tag)] = UnknownElement(bytes(buf[value_start : value_end]))
+    return self._data
+
+  @data.setter
+  def data(self, data: Dict[str, Element]):
+    self._data = data
+
+  def __getitem__(self, key: str) -> Element:
+    data = self.data
+    element = data[key]
+    if element.__class__ is LazyElement:
+      element = element.resolve()
+      data[key] = element
+    return element
+
+  # UserDict's copy reaches into __dict__["data"] which the property replaces
+  def __copy__(self) -> 'LazyPacket':
+    inst = LazyPacket()
+    inst.data = self.data.copy()
+    return inst
+
+  def copy(self) -> 'LazyPacket':
+    return self.__copy__()
+
+  def toJson(self) -> Dict[str, Element]:
+    for key in self.data:
+      self[key]
     return self.data
\ No newline at end of file
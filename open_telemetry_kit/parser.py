@@ -1,7 +1,11 @@
 from .telemetry import Telemetry
 from .element import Element
+from .packet import Packet
 from abc import ABCMeta
 from abc import abstractmethod
+import os
+import time
+from typing import Iterator
 
 class Parser(metaclass=ABCMeta):
   def __init__(self, source, 
@@ -29,4 +33,50 @@ class Parser(metaclass=ABCMeta):
 
   @abstractmethod
   def read(self) -> Telemetry:
-    pass
\ No newline at end of file
+    pass
+
+  # Telemetry appended to the source since the last poll(). Only the bytes
+  # added since then are parsed. Anything incomplete at the end is held back
+  # until it's finished. Parsers that can follow a source override this
+  def poll(self) -> Telemetry:
+    raise ValueError("Follow mode isn't supported for {} sources like {}".format(self.tel_type, self.source))
+
+  # Follows a source that's still being written (e.g. by a recorder during a
+  # flight) and yields packets as they're appended
+  # poll_interval: Seconds to wait when a poll finds nothing new
+  # idle_timeout: Stop after this many seconds without new packets. None
+  #   follows forever
+  def follow(self, poll_interval: float = 1.0, idle_timeout: float = None) -> Iterator[Packet]:
+    idle = 0
+    while True:
+      tel = self.poll()
+      if len(tel) > 0:
+        idle = 0
+        yield from tel
+        continue
+
+      if idle_timeout is not None and idle >= idle_timeout:
+        return
+      time.sleep(poll_interval)
+      idle += poll_interval
+
+  # Returns the bytes appended to the source since the last call. Starts
+  # over from the beginning if the file shrank (e.g. it was replaced)
+  def _read_appended(self) -> bytes:
+    offset = getattr(self, "_follow_offset", 0)
+    with open(self.source, "rb") as fl:
+      size = os.fstat(fl.fileno()).st_size
+      if size < offset:
+        self.logger.warn("{} shrank. Following it from the beginning".format(self.source))
+        offset = 0
+      fl.seek(offset)
+      data = fl.read(size - offset)
+
+    if offset == 0:
+      self._reset_follow()
+    self._follow_offset = offset + len(data)
+    return data
+
+  # Clears whatever was held back from previous polls
+  def _reset_follow(self):
+    self._follow_tail = b""
@@ -5,12 +5,15 @@ from .element import Element, UnknownElement
 from .elements import TimestampElement, TimeframeBeginElement, TimeframeEndElement, DatetimeElement
 from .elements import LatitudeElement, LongitudeElement, AltitudeElement
 import open_telemetry_kit.detector as detector
+from .cache import get_cache
+from .isobmff import read_text_samples
 
 from datetime import timedelta
 from dateutil import parser as dup
+import io
 import re
 import os
-from typing import Dict
+from typing import BinaryIO, Dict, List, Tuple
 import logging
 
 class SRTParser(Parser):
@@ -35,19 +38,15 @@ class SRTParser(Parser):
     _, _, ext = detector.split_path(self.source)
     if self.is_embedded and ext != ".srt":
       if self.require_timestamp:
-        video_metadata = detector.read_video_metadata(self.source)
-        if video_metadata and "streams" in video_metadata \
-           and "tags" in video_metadata["streams"][0]     \
-           and "creation_time" in video_metadata["streams"][0]["tags"]:
-
-          video_datetime = video_metadata["streams"][0]["tags"]["creation_time"]
-          self.beg_timestamp = dup.parse(video_datetime).timestamp()
-          self.logger.info("Setting video creation time to: {}".format(self.beg_timestamp))
-        else:
-          self.logger.warn("Could not find creation time for video.")
+        self._read_creation_time()
 
-      srt = detector.read_embedded_subtitles(self.source)
-      self._process(srt.splitlines(True), tel)
+      # MP4/MOV text tracks are read directly. Anything else goes through ffmpeg
+      samples = read_text_samples(self.source)
+      if samples is not None:
+        self._process_samples(samples, tel)
+      else:
+        srt = self._read_subtitles()
+        self._process(srt.splitlines(True), tel)
 
     else:
       with open(self.source, 'r') as srt:
@@ -58,6 +57,76 @@ class SRTParser(Parser):
 
     return tel
 
+  # Parses the SRT written to a pipe by detector.open_telemetry_streams
+  def _read_pipe(self, pipe: BinaryIO) -> Telemetry:
+    tel = Telemetry()
+    if self.require_timestamp:
+      self._read_creation_time()
+
+    srt = io.TextIOWrapper(pipe, encoding="utf-8")
+    self._process(srt, tel)
+    # Leave the pipe open for the caller
+    srt.detach()
+
+    if len(tel) == 0:
+      self.logger.warn("No telemetry was found. Returning empty Telemetry()")
+    return tel
+
+  # Timestamps are estimated from the video's creation time when the
+  # subtitles don't have them
+  def _read_creation_time(self):
+    video_metadata = detector.read_video_metadata(self.source)
+    if video_metadata and "streams" in video_metadata \
+       and "tags" in video_metadata["streams"][0]     \
+       and "creation_time" in video_metadata["streams"][0]["tags"]:
+
+      video_datetime = video_metadata["streams"][0]["tags"]["creation_time"]
+      self.beg_timestamp = dup.parse(video_datetime).timestamp()
+      self.logger.info("Setting video creation time to: {}".format(self.beg_timestamp))
+    else:
+      self.logger.warn("Could not find creation time for video.")
+
+  # Follow mode for a standalone .srt that's still being written. Blocks are
+  # only parsed once the blank line ending them has been written
+  def poll(self) -> Telemetry:
+    _, _, ext = detector.split_path(self.source)
+    if self.is_embedded and ext != ".srt":
+      raise ValueError("Follow mode needs a standalone .srt file, not {}".format(self.source))
+
+    appended = self._read_appended()
+    data = self._follow_tail + appended
+    # Everything up to the last blank line is made of complete blocks
+    end = 0
+    lf = data.rfind(b"\n\n")
+    if lf >= 0:
+      end = lf + 2
+    crlf = data.rfind(b"\r\n\r\n")
+    if crlf >= 0:
+      end = max(end, crlf + 4)
+
+    tel = Telemetry()
+    if end > 0:
+      srt = data[:end].decode("utf-8").replace("\r\n", "\n")
+      self._process(srt.splitlines(True), tel)
+    self._follow_tail = data[end:]
+
+    return tel
+
+  # The subtitles ffmpeg extracts from the video. If the cache is enabled
+  # they're kept there so an unchanged video is only extracted once
+  def _read_subtitles(self) -> str:
+    cache = get_cache()
+    key = cache.key(self.source) if cache is not None else None
+    if key is not None:
+      srt = cache.load(key, "srt")
+      if srt is not None:
+        return srt.decode("utf-8")
+
+    srt = detector.read_embedded_subtitles(self.source)
+    if key is not None:
+      cache.store(key, "srt", srt.encode("utf-8"))
+    return srt
+
   def _process(self, srt: str, tel: Telemetry):
     block = ""
     for line in srt:
@@ -79,6 +148,21 @@ class SRTParser(Parser):
       else:
         block += line
 
+  # Same as _process but for (start, end, text) subtitle samples, which
+  # already have their timeframe so only the text is parsed
+  def _process_samples(self, samples: List[Tuple[float, float, str]], tel: Telemetry):
+    for start, end, text in samples:
+      packet = Packet()
+      packet[TimeframeBeginElement.name] = TimeframeBeginElement(start)
+      packet[TimeframeEndElement.name] = TimeframeEndElement(end)
+      text = text.replace("\r\n", "\n")
+      if not text.endswith("\n"):
+        text += "\n"
+      self._extractDatetime(text, packet)
+      self._extractData(text, packet)
+      self.logger.info("Adding new packet.")
+      tel.append(packet)
+
   # Example timeframe:
   # 00:00:00,033 --> 00:00:00,066
   def _extractTimeframe(self, line: str, packet: Dict[str, Element]):
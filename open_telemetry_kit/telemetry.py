@@ -30,9 +30,8 @@ class Telemetry(UserList):
       return None
 
     time_and_dur = []
-    for video in videos:
-      video_metadata = otk.detector.read_video_metadata(video)
-      
+    videos_metadata = otk.detector.read_video_metadata_batch(videos)
+    for video, video_metadata in zip(videos, videos_metadata):
       if video_metadata and "streams" in video_metadata:
         video_creation = None
         video_duration = None
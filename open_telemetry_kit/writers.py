@@ -19,4 +19,9 @@ def telemetryToCSV(tel: Telemetry, file: str):
     writer = csv.DictWriter(f, fieldnames=tel[0].keys())
     writer.writeheader()
     for packet in tel:
-      writer.writerow(packet)
\ No newline at end of file
+      writer.writerow(packet)
+
+def telemetryToKLV(tel: Telemetry, file: str):
+  from .klv_encoder import KLVEncoder
+  with open(file, 'wb') as f:
+    f.write(KLVEncoder().encode(tel))